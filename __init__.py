@@ -7,10 +7,22 @@ from . import production
 def register():
     Pool.register(
         production.Party,
+        production.Configuration,
         production.PurchaseRequest,
         production.BOM,
         production.Production,
         production.Purchase,
+        production.PurchaseLine,
         production.PartyProductionWarehouse,
         production.Move,
+        production.ShipmentInternal,
+        production.SubcontractWork,
+        production.SubcontractMetric,
+        production.SubcontractMetricSummary,
+        production.Cron,
+        production.SubcontractPlanStart,
+        production.SubcontractPlanLine,
         module='production_subcontract', type_='model')
+    Pool.register(
+        production.SubcontractPlan,
+        module='production_subcontract', type_='wizard')
@@ -2,12 +2,120 @@
 # copyright notices and license terms.
 from trytond.pool import Pool, PoolMeta
 from trytond.model import (Workflow, ModelView, fields, MultiValueMixin,
-    ValueMixin, ModelSQL, dualmethod)
+    ValueMixin, ModelSQL, dualmethod, Index, Model)
 from trytond.pyson import Eval, Bool
+from trytond.rpc import RPC
+from trytond.wizard import Button, StateView, Wizard
 from trytond.i18n import gettext
 from trytond.exceptions import UserError
+from trytond.modules.currency.fields import Monetary
 from trytond.modules.product import round_price
+from trytond import backend
+from trytond.cache import Cache
+from trytond.config import config
+from trytond.tools import grouped_slice
+from trytond.transaction import Transaction
 from decimal import Decimal
+from collections import defaultdict
+from contextlib import contextmanager
+from contextvars import ContextVar
+from functools import wraps
+from sql import Literal, Null
+from sql.aggregate import Count, Max, Min, Sum
+from sql.conditionals import Case, Coalesce
+import logging
+import time
+
+logger = logging.getLogger(__name__)
+
+_query_counters = ContextVar('production_subcontract_queries', default=None)
+
+
+@contextmanager
+def count_queries():
+    """Yield the list of the SQL queries executed on the connection since
+    entering the context; nested calls share the outermost trace"""
+    queries = []
+    counters = _query_counters.get()
+    if counters is not None:
+        # Nested call, the outer one already traces the queries
+        counters.append(queries)
+        try:
+            yield queries
+        finally:
+            # The lists may be equal so it is removed by identity
+            del counters[next(
+                    i for i, c in enumerate(counters) if c is queries)]
+        return
+
+    counters = [queries]
+    token = _query_counters.set(counters)
+
+    def record(query):
+        for counter in counters:
+            counter.append(query)
+    connection = Transaction().connection
+    try:
+        if backend.name == 'sqlite':
+            db_logger = logging.getLogger('trytond.backend.sqlite.database')
+            debug = (db_logger.debug
+                if db_logger.isEnabledFor(logging.DEBUG) else None)
+
+            def trace(query):
+                record(query)
+                if debug:
+                    debug(query)
+            connection.set_trace_callback(trace)
+            try:
+                yield queries
+            finally:
+                connection.set_trace_callback(debug)
+        elif backend.name == 'postgresql':
+            cursor_factory = connection.cursor_factory
+
+            class CountingCursor(cursor_factory):
+                def execute(self, query, *args, **kwargs):
+                    record(query)
+                    return super().execute(query, *args, **kwargs)
+            connection.cursor_factory = CountingCursor
+            try:
+                yield queries
+            finally:
+                connection.cursor_factory = cursor_factory
+        else:
+            yield queries
+    finally:
+        _query_counters.reset(token)
+
+
+def instrumented(func):
+    """Measure the calls of func on records when the instrumentation is
+    activated in the production_subcontract section of the configuration"""
+    @wraps(func)
+    def wrapper(cls, records, *args, **kwargs):
+        if not config.getboolean(
+                'production_subcontract', 'instrumentation', default=False):
+            return func(cls, records, *args, **kwargs)
+        with count_queries() as queries:
+            start = time.perf_counter()
+            result = func(cls, records, *args, **kwargs)
+            duration = time.perf_counter() - start
+            count = len(queries)
+        method = '%s.%s' % (cls.__name__, func.__name__)
+        logger.info('%s: %s records in %.3fs with %s queries',
+            method, len(records), duration, count)
+        if (config.getboolean('production_subcontract',
+                    'instrumentation_store', default=False)
+                and not Transaction().readonly):
+            Metric = Pool().get('production.subcontract.metric')
+            Metric.create([{
+                        'method': method,
+                        'records': len(records),
+                        'duration': duration,
+                        'queries': count,
+                        }])
+        return result
+    return wrapper
 
 
 class Party(MultiValueMixin, metaclass=PoolMeta):
@@ -18,6 +126,50 @@ class Party(MultiValueMixin, metaclass=PoolMeta):
                 ]))
     production_warehouses = fields.One2Many('party.party.production_warehouse',
         'party', 'Warehouses')
+    _production_warehouses_cache = Cache(
+        'party.party.get_production_warehouses', context=False)
+
+    @classmethod
+    def get_production_warehouses(cls, parties, company=None):
+        """Return a dictionary with the production warehouse id of each
+        party for the company"""
+        pool = Pool()
+        Value = pool.get('party.party.production_warehouse')
+        if company is None:
+            company = Transaction().context.get('company')
+        if isinstance(company, Model):
+            company = company.id
+        pattern = {}
+        if 'company' in Value._fields:
+            pattern['company'] = company
+        else:
+            company = None
+
+        warehouses, missing = {}, set()
+        for party in parties:
+            warehouse = cls._production_warehouses_cache.get(
+                (party.id, company), -1)
+            if warehouse == -1:
+                missing.add(party.id)
+            else:
+                warehouses[party.id] = warehouse
+        if missing:
+            found = {}
+            for sub_ids in grouped_slice(
+                    list(missing), backend.MAX_QUERY_PARAMS):
+                values = Value.search([
+                        ('party', 'in', list(sub_ids)),
+                        ], order=[('id', 'ASC')])
+                for value in values:
+                    if (value.party.id not in found
+                            and value.match(pattern, match_none=False)):
+                        found[value.party.id] = (value.production_warehouse.id
+                            if value.production_warehouse else None)
+            for party_id in missing:
+                warehouses[party_id] = found.get(party_id)
+                cls._production_warehouses_cache.set(
+                    (party_id, company), warehouses[party_id])
+        return warehouses
 
 
 class PartyProductionWarehouse(ModelSQL, ValueMixin):
@@ -30,20 +182,60 @@ class PartyProductionWarehouse(ModelSQL, ValueMixin):
                 ('type', '=', 'warehouse'),
                 ])
 
+    @classmethod
+    def on_modification(cls, mode, records, field_names=None):
+        pool = Pool()
+        Party = pool.get('party.party')
+        super().on_modification(mode, records, field_names=field_names)
+        Party._production_warehouses_cache.clear()
+
 
 class PurchaseRequest(metaclass=PoolMeta):
     __name__ = 'purchase.request'
+    productions = fields.One2Many('production', 'purchase_request',
+        'Productions', readonly=True)
 
     @classmethod
-    def get_origin(cls):
-        Model = Pool().get('ir.model')
-        res = super(PurchaseRequest, cls).get_origin()
-        models = Model.search([
-                ('name', '=', 'production'),
-                ])
-        for model in models:
-            res.append([model.name, model.string])
-        return res
+    def write(cls, *args):
+        pool = Pool()
+        Production = pool.get('production')
+        actions = iter(args)
+        to_update = []
+        for requests, values in zip(actions, actions):
+            if 'party' in values:
+                to_update.extend(requests)
+        super(PurchaseRequest, cls).write(*args)
+        if to_update:
+            Production.set_supplier(Production.search([
+                        ('purchase_request', 'in', [r.id for r in to_update]),
+                        ]))
+
+    @classmethod
+    def _get_origin(cls):
+        models = super()._get_origin()
+        models.add('production')
+        return models
+
+
+class Configuration(metaclass=PoolMeta):
+    __name__ = 'production.configuration'
+    group_incoming_shipments = fields.Boolean('Group Incoming Shipments',
+        help='Create a single incoming shipment for all the subcontracted '
+        'productions processed together that share the same supplier '
+        'warehouse and destination warehouse.')
+    aggregate_purchase_requests = fields.Boolean(
+        'Aggregate Purchase Requests',
+        help='Create a single purchase request for the subcontracted '
+        'productions that share the same subcontract product, supplier, '
+        'warehouse and purchase date.')
+    queue_subcontract_processing = fields.Boolean(
+        'Queue Subcontract Processing',
+        help='Create the incoming shipments of subcontracted productions in '
+        'the task queue instead of when the purchase is processed.')
+    queue_subcontract_assignment = fields.Boolean(
+        'Queue Subcontract Assignment',
+        help='Try to assign the subcontracted productions in the task queue '
+        'instead of when their incoming shipment changes of state.')
 
 
 class BOM(metaclass=PoolMeta):
@@ -74,11 +266,14 @@ class Production(metaclass=PoolMeta):
         'Destination Warehouse', domain=[
             ('type', '=', 'warehouse'),
             ], readonly=True)
-    supplier = fields.Function(fields.Many2One('party.party', 'Supplier',
+    supplier = fields.Many2One('party.party', 'Supplier', readonly=True,
         context={
             'company': Eval('company', -1),
-        }, depends=['company']),
-        'get_supplier', searcher='search_supplier')
+        }, depends=['company'])
+    # Not rounded to be added to the cost of the inputs before rounding
+    subcontract_cost = fields.Numeric('Subcontract Cost', readonly=True,
+        help='The cost of the subcontract purchase line stored when the '
+        'purchase is processed.')
 
     @classmethod
     def __setup__(cls):
@@ -89,16 +284,65 @@ class Production(metaclass=PoolMeta):
                         Bool(Eval('subcontract_product')) &
                         ~Bool(Eval('purchase_request'))),
                     'icon': 'tryton-go-home',
-                    }
+                    },
+                'reverse_purchase_request': {
+                    'invisible': ~(Eval('state').in_(['draft', 'waiting']) &
+                        Bool(Eval('destination_warehouse'))),
+                    },
+                })
+        cls.cost.getter = 'get_costs'
+        cls.__rpc__.update({
+                'plan_purchase_request': RPC(readonly=True, instantiate=0),
                 })
+        t = cls.__table__()
+        cls._sql_indexes.update({
+                Index(t, (t.supplier, Index.Equality()),
+                    where=t.supplier != Null),
+                Index(t, (t.purchase_request, Index.Equality()),
+                    where=t.purchase_request != Null),
+                Index(t, (t.incoming_shipment, Index.Equality()),
+                    where=t.incoming_shipment != Null),
+                Index(t, (t.destination_warehouse, Index.Equality()),
+                    where=t.destination_warehouse != Null),
+                })
+
+    @classmethod
+    def __register__(cls, module_name):
+        pool = Pool()
+        PurchaseRequest = pool.get('purchase.request')
+        table = cls.__table__()
+        request = PurchaseRequest.__table__()
+        cursor = Transaction().connection.cursor()
+        table_h = cls.__table_handler__(module_name)
+
+        supplier_exist = table_h.column_exist('supplier')
 
-    def get_supplier(self, name):
-        return (self.purchase_request.party.id if self.purchase_request and
-            self.purchase_request.party else None)
+        super(Production, cls).__register__(module_name)
+
+        # Migration from 8.0: supplier is stored
+        if not supplier_exist:
+            cursor.execute(*table.update(
+                    [table.supplier],
+                    [request.select(request.party,
+                            where=request.id == table.purchase_request)],
+                    where=table.purchase_request != Null))
 
     @classmethod
-    def search_supplier(cls, name, clause):
-        return [('purchase_request.party',) + tuple(clause[1:])]
+    def set_supplier(cls, productions):
+        "Set the supplier from the party of the purchase request"
+        suppliers = defaultdict(list)
+        for production in productions:
+            request = production.purchase_request
+            supplier = request.party if request else None
+            if production.supplier != supplier:
+                suppliers[supplier].append(production)
+        args = []
+        for supplier, sub_productions in suppliers.items():
+            args.extend((sub_productions, {
+                        'supplier': supplier.id if supplier else None,
+                        }))
+        if args:
+            cls.write(*args)
 
     @classmethod
     def copy(cls, productions, default=None):
@@ -107,20 +351,57 @@ class Production(metaclass=PoolMeta):
         default['purchase_request'] = None
         default['incoming_shipment'] = None
         default['destination_warehouse'] = None
+        default['supplier'] = None
+        default['subcontract_cost'] = None
         return super(Production, cls).copy(productions, default)
 
     @classmethod
+    def create_subcontract_purchase_requests(cls, size=1000):
+        """Create the purchase requests of all the pending subcontracted
+        productions
+
+        Productions are processed by chunks of size and each chunk is
+        committed so a new run resumes with the productions that are still
+        without purchase request.
+        """
+        transaction = Transaction()
+        context = transaction.context
+        domain = [
+            ('state', 'in', ['draft', 'waiting']),
+            ('subcontract_product', '!=', None),
+            ('purchase_request', '=', None),
+            ]
+        if context.get('company'):
+            domain.append(('company', '=', context['company']))
+        last_id = 0
+        while productions := cls.search(domain + [('id', '>', last_id)],
+                order=[('id', 'ASC')], limit=size):
+            cls.create_purchase_request(productions)
+            last_id = productions[-1].id
+            transaction.commit()
+
+    @classmethod
+    @instrumented
     @ModelView.button
     def create_purchase_request(cls, productions):
-        for production in productions:
-            if not production.subcontract_product:
-                continue
-            if not production.state in ('draft', 'waiting'):
-                continue
-            request = production._get_purchase_request()
-            request.save()
+        pool = Pool()
+        PurchaseRequest = pool.get('purchase.request')
+        Config = pool.get('production.configuration')
+
+        to_request = [p for p in productions
+            if p.subcontract_product
+            and p.state in ('draft', 'waiting')
+            and not p.purchase_request]
+        if not to_request:
+            return
+        requests = [p._get_purchase_request() for p in to_request]
+        if Config(1).aggregate_purchase_requests:
+            requests = cls._aggregate_purchase_requests(requests)
+        PurchaseRequest.save(list(dict.fromkeys(requests)))
+        for production, request in zip(to_request, requests):
             production.purchase_request = request
-            production.save()
+            production.supplier = request.party
+        cls.save(to_request)
 
     def on_change_product(self):
         super(Production, self).on_change_product()
@@ -147,63 +428,412 @@ class Production(metaclass=PoolMeta):
             )
 
     @classmethod
-    def process_purchase_request(cls, productions):
+    def _aggregate_purchase_requests(cls, requests):
+        """Return for each request the draft request in which it is merged
+
+        Requests of productions are merged when they share the same
+        subcontract product, supplier, warehouse and purchase date.
+        """
+        pool = Pool()
+        PurchaseRequest = pool.get('purchase.request')
+
+        def key(request):
+            return (request.company.id, request.product.id,
+                request.unit.id, request.party.id if request.party else None,
+                request.warehouse.id if request.warehouse else None,
+                getattr(request, 'purchase_date', None))
+
+        best_suppliers = {}
+        for request in requests:
+            production = request.origin
+            if (not getattr(request, 'supply_date', None)
+                    and isinstance(production, cls)):
+                request.supply_date = (production.planned_start_date
+                    or production.planned_date)
+            if not getattr(request, 'party', None):
+                supplier_key = (
+                    request.product, request.supply_date, request.company.id)
+                if supplier_key not in best_suppliers:
+                    best_suppliers[supplier_key] = (
+                        PurchaseRequest.find_best_supplier(request.product,
+                            request.supply_date, company=request.company.id))
+                request.party, request.purchase_date = (
+                    best_suppliers[supplier_key])
+
+        aggregated = {}
+        product_ids = list({r.product.id for r in requests})
+        for sub_ids in grouped_slice(product_ids, backend.MAX_QUERY_PARAMS):
+            for request in PurchaseRequest.search([
+                        ('state', '=', 'draft'),
+                        ('origin', 'like', 'production,%'),
+                        ('product', 'in', list(sub_ids)),
+                        ], order=[('id', 'ASC')]):
+                aggregated.setdefault(key(request), request)
+
+        merged = []
+        for request in requests:
+            target = aggregated.setdefault(key(request), request)
+            if target != request:
+                target.quantity += request.quantity
+                target.computed_quantity = ((target.computed_quantity or 0)
+                    + (request.computed_quantity or 0))
+            merged.append(target)
+        return merged
+
+    @classmethod
+    @instrumented
+    def process_purchase_request(cls, productions, skip_invalid=False):
+        """Move the productions of processed purchases to the subcontract
+        warehouse of the supplier
+
+        All the productions are checked before anything is written.
+        The failures are reported together, unless skip_invalid is set.
+        In that case the valid productions are processed and the ids of the
+        rejected ones are returned.
+        """
         pool = Pool()
         ShipmentInternal = pool.get('stock.shipment.internal')
+
+        to_process = cls._get_processable(productions)
+        # Productions locked by a concurrent process are left to it
+        to_process = cls._lock_unprocessed(to_process)
+        if not to_process:
+            return []
+
+        warehouses, errors = cls._check_purchase_request(to_process)
+        if errors:
+            if not skip_invalid:
+                messages = list(dict.fromkeys(errors.values()))
+                if len(messages) == 1:
+                    raise UserError(messages[0])
+                raise UserError(gettext(
+                        'production_subcontract.msg_invalid_subcontracts',
+                        count=len(errors)),
+                    '\n'.join(messages))
+            logger.warning('Skip invalid subcontracted productions: %s',
+                ', '.join(errors.values()))
+            to_process = [p for p in to_process if p not in errors]
+
+        shipments, to_relocate = cls._get_purchase_request_plan(
+            to_process, warehouses)
+        for production in to_process:
+            production.destination_warehouse = production.warehouse
+            production.warehouse = warehouses[production]
+            production.location = production.warehouse.production_location
+            production.incoming_shipment = shipments[production]
+
+        shipments = list(dict.fromkeys(shipments.values()))
+        ShipmentInternal.save(shipments)
+        cls._relocate_moves(to_relocate)
+        subcontract_costs = cls._get_subcontract_costs(to_process)
+        for production in to_process:
+            production.subcontract_cost = subcontract_costs.get(production.id)
+        cls.save(to_process)
+        # The productions are linked before waiting the shipments so they
+        # are found by their assignment trigger
+        ShipmentInternal.wait(shipments)
+        return [p.id for p in errors]
+
+    @classmethod
+    def _get_processable(cls, productions, purchase_states=None):
+        """Return the productions not yet processed whose purchase is in
+        purchase_states"""
+        if purchase_states is None:
+            purchase_states = {'processing', 'done'}
+        to_process = []
         for production in productions:
             if not (production.purchase_request and
                     production.purchase_request.purchase and
                     production.purchase_request.purchase.state in
-                        ('processing', 'done')):
+                        purchase_states):
+                continue
+            if (production.destination_warehouse
+                    or production.incoming_shipment):
                 continue
-            if production.destination_warehouse:
+            to_process.append(production)
+        return to_process
+
+    @classmethod
+    def _get_purchase_request_plan(cls, productions, warehouses):
+        """Return the unsaved incoming shipment of each production and the
+        moves to relocate per (from, to) locations
+
+        Nothing is written so it is shared by the processing and its plan.
+        """
+        Config = Pool().get('production.configuration')
+
+        config = Config(1)
+        shipments, production_shipments = {}, {}
+        to_relocate = defaultdict(list)
+        for production in productions:
+            warehouse = warehouses[production]
+            from_location = warehouse.storage_location
+            to_location = production.warehouse.storage_location
+            if config.group_incoming_shipments:
+                key = (production.company, from_location, to_location)
+            else:
+                key = production
+            shipment = shipments.get(key)
+            if not shipment:
+                shipment = production._get_incoming_shipment(
+                    from_location, to_location)
+                shipment.moves = []
+                shipments[key] = shipment
+            shipment.moves += tuple(
+                production._get_incoming_shipment_move(output,
+                    from_location, to_location)
+                for output in production.outputs)
+            production_shipments[production] = shipment
+
+            storage_location = warehouse.storage_location
+            production_location = warehouse.production_location
+            to_relocate[(storage_location, production_location)].extend(
+                production.inputs)
+            to_relocate[(production_location, storage_location)].extend(
+                production.outputs)
+        return production_shipments, to_relocate
+
+    @classmethod
+    def plan_purchase_request(cls, productions):
+        """Return what process_purchase_request would do with productions
+        without writing nor locking anything
+
+        The productions of purchases not yet confirmed are also planned.
+        The result is a dictionary with lists of:
+
+            - productions: the production id with its supplier warehouse,
+              destination warehouse and index of its incoming shipment
+            - shipments: the company, locations, production ids and moves
+              of the incoming shipments to create
+            - moves: the ids of the moves to relocate with their new
+              locations
+            - errors: the production id with its error message
+        """
+        to_process = cls._get_processable(productions,
+            purchase_states={'draft', 'quotation', 'confirmed', 'processing',
+                'done'})
+        warehouses, errors = cls._check_purchase_request(to_process)
+        to_process = [p for p in to_process if p not in errors]
+        shipments, to_relocate = cls._get_purchase_request_plan(
+            to_process, warehouses)
+
+        indexes = {s: i for i, s in enumerate(
+                dict.fromkeys(shipments.values()))}
+        plan = {
+            'productions': [],
+            'shipments': [None] * len(indexes),
+            'moves': [],
+            'errors': [{
+                    'production': p.id,
+                    'message': m,
+                    } for p, m in errors.items()],
+            }
+        for production in to_process:
+            shipment = shipments[production]
+            index = indexes[shipment]
+            plan['productions'].append({
+                    'production': production.id,
+                    'warehouse': warehouses[production].id,
+                    'destination_warehouse': production.warehouse.id,
+                    'shipment': index,
+                    })
+            if plan['shipments'][index] is None:
+                plan['shipments'][index] = {
+                    'company': shipment.company.id,
+                    'from_location': shipment.from_location.id,
+                    'to_location': shipment.to_location.id,
+                    'productions': [],
+                    'moves': [{
+                            'product': m.product.id,
+                            'quantity': m.quantity,
+                            'unit': m.unit.id,
+                            } for m in shipment.moves],
+                    }
+            plan['shipments'][index]['productions'].append(production.id)
+        for (from_location, to_location), moves in to_relocate.items():
+            for move in cls._get_moves_to_relocate(
+                    moves, from_location, to_location):
+                plan['moves'].append({
+                        'move': move.id,
+                        'from_location': from_location.id,
+                        'to_location': to_location.id,
+                        })
+        return plan
+
+    @classmethod
+    def _relocate_moves(cls, to_relocate):
+        """Write the locations of the moves with one write per pair
+
+        to_relocate is a dictionary of moves per (from, to) locations.
+        The done and cancelled moves and those already at the locations are
+        skipped, the others are left to the checks of stock.move.
+        """
+        Move = Pool().get('stock.move')
+
+        args = []
+        for (from_location, to_location), moves in to_relocate.items():
+            moves = cls._get_moves_to_relocate(
+                moves, from_location, to_location)
+            if moves:
+                args.extend((moves, {
+                            'from_location': from_location.id,
+                            'to_location': to_location.id,
+                            }))
+        if args:
+            Move.write(*args)
+
+    @property
+    def is_subcontract_relocatable(self):
+        "Whether the production and its moves can change of warehouse"
+        return (self.state in {'draft', 'waiting'}
+            and not any(m.state == 'assigned'
+                for m in self.inputs + self.outputs))
+
+    @classmethod
+    def _get_moves_to_relocate(cls, moves, from_location, to_location):
+        return [m for m in moves
+            if m.state not in {'done', 'cancelled'}
+            and (m.from_location != from_location
+                or m.to_location != to_location)]
+
+    @classmethod
+    @ModelView.button
+    def reverse_purchase_request(cls, productions):
+        """Move back the processed productions to their destination warehouse
+
+        Only the relocatable productions with an incoming shipment still in
+        draft or waiting are reversed.
+        The incoming shipments left without production are cancelled and
+        deleted, the others are synchronized with their remaining productions.
+        """
+        pool = Pool()
+        ShipmentInternal = pool.get('stock.shipment.internal')
+
+        to_reverse = [p for p in productions
+            if p.destination_warehouse
+            and p.is_subcontract_relocatable
+            and (not p.incoming_shipment
+                or p.incoming_shipment.state in {'draft', 'waiting'})]
+        if not to_reverse:
+            return
+
+        shipments = list({p.incoming_shipment for p in to_reverse
+                if p.incoming_shipment})
+        # The moves are relocated first to respect the domains of production
+        to_write = defaultdict(list)
+        to_relocate = defaultdict(list)
+        for production in to_reverse:
+            warehouse = production.destination_warehouse
+            to_write[warehouse].append(production)
+            picking_location = (warehouse.production_picking_location
+                or warehouse.storage_location)
+            output_location = (warehouse.production_output_location
+                or warehouse.storage_location)
+            production_location = warehouse.production_location
+            to_relocate[(picking_location, production_location)].extend(
+                production.inputs)
+            to_relocate[(production_location, output_location)].extend(
+                production.outputs)
+        cls._relocate_moves(to_relocate)
+
+        args = []
+        for warehouse, sub_productions in to_write.items():
+            args.extend((sub_productions, {
+                        'warehouse': warehouse.id,
+                        'location': warehouse.production_location.id,
+                        'destination_warehouse': None,
+                        'incoming_shipment': None,
+                        'subcontract_cost': None,
+                        }))
+        cls.write(*args)
+
+        remaining = []
+        for sub_shipments in grouped_slice(
+                shipments, backend.MAX_QUERY_PARAMS):
+            remaining.extend(cls.search([
+                        ('incoming_shipment', 'in',
+                            [s.id for s in sub_shipments]),
+                        ]))
+        if remaining:
+            cls._sync_outputs_to_shipment(remaining)
+        used = {p.incoming_shipment for p in remaining}
+        to_delete = [s for s in shipments if s not in used]
+        if to_delete:
+            ShipmentInternal.cancel(to_delete)
+            ShipmentInternal.delete(to_delete)
+
+    @classmethod
+    def _lock_unprocessed(cls, productions):
+        """Lock and return the productions that are still not processed
+
+        The rows locked by another transaction are skipped when the database
+        supports SKIP LOCKED, otherwise the lock waits for them.
+        """
+        transaction = Transaction()
+        database = transaction.database
+        production = cls.__table__()
+        cursor = transaction.connection.cursor()
+
+        if database.has_select_for():
+            For = database.get_select_for_skip_locked()
+            for_ = For('UPDATE')
+        else:
+            for_ = None
+        ids = set()
+        for sub_ids in grouped_slice(
+                [p.id for p in productions], backend.MAX_QUERY_PARAMS):
+            cursor.execute(*production.select(production.id,
+                    where=fields.SQL_OPERATORS['in'](production.id, sub_ids)
+                    & (production.incoming_shipment == Null)
+                    & (production.destination_warehouse == Null),
+                    for_=for_))
+            ids.update(i for i, in cursor)
+        return [p for p in productions if p.id in ids]
+
+    @classmethod
+    def _check_purchase_request(cls, productions):
+        """Return the subcontract warehouse of the valid productions and the
+        error message of the others"""
+        subcontract_warehouses = cls._get_subcontract_warehouses(productions)
+        warehouses, errors = {}, {}
+        for production in productions:
+            if not production.is_subcontract_relocatable:
+                errors[production] = gettext(
+                    'production_subcontract.msg_subcontract_not_relocatable',
+                    production=production.rec_name)
                 continue
-            subcontract_warehouse = production._get_subcontract_warehouse()
+            subcontract_warehouse = subcontract_warehouses[production]
             if not subcontract_warehouse:
-                raise UserError(gettext(
+                errors[production] = gettext(
                     'production_subcontract.no_subcontract_warehouse',
-                    party=production.purchase_request.party.rec_name))
-            production.destination_warehouse = production.warehouse
-            production.warehouse = subcontract_warehouse
-            if not production.warehouse.production_location:
-                raise UserError(gettext(
+                    party=production.purchase_request.party.rec_name)
+                continue
+            if not subcontract_warehouse.production_location:
+                errors[production] = gettext(
                     'production_subcontract.no_warehouse_production_location',
-                    warehouse=production.warehouse.rec_name))
-            production.location = production.warehouse.production_location
-
-            from_location = production.warehouse.storage_location
-            to_location = production.destination_warehouse.storage_location
+                    warehouse=subcontract_warehouse.rec_name)
+                continue
+            from_location = subcontract_warehouse.storage_location
+            to_location = production.warehouse.storage_location
             # in case production warehouse is the same party.production_warehouse,
             # can not create internal shipments
             if from_location == to_location:
-                raise UserError(gettext(
+                errors[production] = gettext(
                     'production_subcontract.msg_same_production_location',
                     production=production.rec_name,
-                    warehouse=from_location.rec_name))
-
-            shipment = ShipmentInternal()
-            shipment.from_location = from_location
-            shipment.to_location = to_location
-            shipment.moves = []
-            for output in production.outputs:
-                move = production._get_incoming_shipment_move(output,
-                    from_location, to_location)
-                shipment.moves += (move,)
-            shipment.save()
-            ShipmentInternal.wait([shipment])
-            production.incoming_shipment = shipment
-
-            storage_location = production.warehouse.storage_location
-            production_location = production.warehouse.production_location
-            for move in production.inputs:
-                move.from_location = storage_location
-                move.to_location = production_location
-                move.save()
-            for move in production.outputs:
-                move.from_location = production_location
-                move.to_location = storage_location
-                move.save()
-            production.save()
+                    warehouse=from_location.rec_name)
+                continue
+            warehouses[production] = subcontract_warehouse
+        return warehouses, errors
+
+    def _get_incoming_shipment(self, from_location, to_location):
+        ShipmentInternal = Pool().get('stock.shipment.internal')
+
+        return ShipmentInternal(
+            company=self.company,
+            from_location=from_location,
+            to_location=to_location,
+            )
 
     def _get_incoming_shipment_move(self, output, from_location, to_location):
         Move = Pool().get('stock.move')
@@ -219,39 +849,196 @@ class Production(metaclass=PoolMeta):
             )
 
     def _get_subcontract_warehouse(self):
-        return (self.purchase_request and self.purchase_request.party
-            and self.purchase_request.party.production_warehouse)
+        return self._get_subcontract_warehouses([self])[self]
+
+    @classmethod
+    def _get_subcontract_warehouses(cls, productions):
+        "Return a dictionary with the subcontract warehouse of each production"
+        pool = Pool()
+        Party = pool.get('party.party')
+        Location = pool.get('stock.location')
+
+        parties = defaultdict(set)
+        for production in productions:
+            request = production.purchase_request
+            if request and request.party:
+                parties[production.company].add(request.party)
+        warehouse_ids = {}
+        for company, company_parties in parties.items():
+            for party_id, warehouse_id in Party.get_production_warehouses(
+                    company_parties, company=company).items():
+                warehouse_ids[company, party_id] = warehouse_id
+        warehouses = {w.id: w for w in Location.browse(
+                [i for i in warehouse_ids.values() if i is not None])}
+
+        result = {}
+        for production in productions:
+            party = (production.purchase_request
+                and production.purchase_request.party)
+            warehouse_id = (warehouse_ids.get((production.company, party.id))
+                if party else None)
+            result[production] = warehouses.get(warehouse_id)
+        return result
+
+    @classmethod
+    def generate_requests(cls, clean=True, warehouses=None):
+        # The subcontract products are set on all the requests at once
+        with Transaction().set_context(_subcontract_product_later=True):
+            requests = super().generate_requests(
+                clean=clean, warehouses=warehouses)
+        if requests:
+            cls.set_subcontract_product(requests)
+        return requests
 
     @classmethod
     def compute_request(cls, product, warehouse, quantity, date, company,
-            order_point=None):
+            order_point=None, **kwargs):
         req = super(Production, cls).compute_request(product, warehouse,
-            quantity, date, company, order_point)
-        if req.bom:
+            quantity, date, company, order_point, **kwargs)
+        if (req.bom and not Transaction().context.get(
+                    '_subcontract_product_later')):
             req.subcontract_product = req.bom.subcontract_product
         return req
 
+    @classmethod
+    def set_subcontract_product(cls, productions):
+        "Set the subcontract product of the BOM on productions without one"
+        pool = Pool()
+        BOM = pool.get('production.bom')
+
+        productions = [p for p in productions
+            if p.bom and not p.subcontract_product]
+        boms = BOM.browse(list({p.bom.id for p in productions}))
+        subcontract_products = {b.id: b.subcontract_product for b in boms}
+
+        to_write = defaultdict(list)
+        for production in productions:
+            subcontract_product = subcontract_products[production.bom.id]
+            if subcontract_product:
+                to_write[subcontract_product].append(production)
+        args = []
+        for subcontract_product, sub_productions in to_write.items():
+            args.extend((sub_productions, {
+                        'subcontract_product': subcontract_product.id,
+                        }))
+        if args:
+            cls.write(*args)
+
     @classmethod
     def write(cls, *args):
         actions = iter(args)
         to_update = []
+        to_set_supplier = []
+        to_cost = []
         for productions, values in zip(actions, actions):
             if 'outputs' in values:
                 to_update.extend(productions)
+            if 'purchase_request' in values and 'supplier' not in values:
+                to_set_supplier.extend(productions)
+            if (values.keys() & {'quantity', 'unit', 'product'}
+                    and 'subcontract_cost' not in values):
+                to_cost.extend(productions)
         super(Production, cls).write(*args)
         if to_update:
-            Production._sync_outputs_to_shipment(to_update)
+            cls._sync_outputs_to_shipment(to_update)
+        if to_set_supplier:
+            cls.set_supplier(cls.browse(to_set_supplier))
+        to_cost = [p for p in cls.browse(to_cost)
+            if p.subcontract_cost is not None]
+        if to_cost:
+            cls.set_subcontract_cost(to_cost)
 
-    # TODO: Missing function to synchronize output production moves with
-    # incoming internal shipment. Should emulate behaviour of ShipmentOut and
-    # ShipmentIn where there is no direct linke between stock moves but are
-    # calculated by product and quantities. See _sync_inventory_to_outgoing in
-    # stock/shipment.py.
     @classmethod
+    @instrumented
     def _sync_outputs_to_shipment(cls, productions):
-        pass
+        """Synchronize the outgoing moves of the incoming shipments with the
+        outputs of their productions.
+
+        As in ShipmentOut and ShipmentIn there is no direct link between the
+        moves, they are matched by product and only the quantity differences
+        are applied.
+        """
+        pool = Pool()
+        Move = pool.get('stock.move')
+        ShipmentInternal = pool.get('stock.shipment.internal')
+        Uom = pool.get('product.uom')
+
+        def active(move):
+            return move.state != 'cancelled'
+
+        shipments = ShipmentInternal.browse({p.incoming_shipment
+                for p in productions if p.incoming_shipment})
+        shipments = [s for s in shipments
+            if s.state in {'request', 'draft', 'waiting'}]
+        if not shipments:
+            return
+
+        # incoming shipments may be shared by several productions
+        output_qty = defaultdict(lambda: defaultdict(float))
+        templates = {}
+        for production in cls.search([
+                    ('incoming_shipment', 'in', [s.id for s in shipments]),
+                    ]):
+            shipment = production.incoming_shipment
+            for output in filter(active, production.outputs):
+                product = output.product
+                output_qty[shipment][product] += Uom.compute_qty(
+                    output.unit, output.quantity, product.default_uom,
+                    round=False)
+                templates.setdefault((shipment, product), (production, output))
+
+        to_save, to_delete = [], []
+        for shipment in shipments:
+            moves = defaultdict(list)
+            for move in filter(active, shipment.outgoing_moves):
+                moves[move.product].append(move)
+            for product in output_qty[shipment].keys() | moves.keys():
+                uom = product.default_uom
+                quantity = output_qty[shipment].get(product, 0)
+                move_qty = {m: Uom.compute_qty(
+                            m.unit, m.quantity, uom, round=False)
+                    for m in moves[product]}
+                delta = uom.round(quantity - sum(move_qty.values()))
+                if not delta:
+                    continue
+                if not moves[product]:
+                    production, output = templates[(shipment, product)]
+                    move = production._get_incoming_shipment_move(output,
+                        shipment.from_location,
+                        shipment.transit_location or shipment.to_location)
+                    move.shipment = shipment
+                    move.planned_date = shipment.planned_date
+                    move.quantity = Uom.compute_qty(
+                        uom, quantity, move.unit)
+                    to_save.append(move)
+                elif delta > 0:
+                    move = moves[product][-1]
+                    move.quantity = Uom.compute_qty(
+                        uom, move_qty[move] + delta, move.unit)
+                    to_save.append(move)
+                else:
+                    for move in reversed(moves[product]):
+                        if uom.round(move_qty[move] + delta) <= 0:
+                            to_delete.append(move)
+                            delta += move_qty[move]
+                        else:
+                            move.quantity = Uom.compute_qty(
+                                uom, move_qty[move] + delta, move.unit)
+                            to_save.append(move)
+                            break
+        Move.save(to_save)
+        Move.delete(to_delete)
+
+        # Propagate the changes to the incoming moves of shipments in transit
+        shipments = ShipmentInternal.browse(
+            [s for s in shipments if s.transit_location])
+        ShipmentInternal._sync_moves(shipments)
+        Move.delete([m for s in ShipmentInternal.browse(shipments)
+                for m in s.incoming_moves
+                if m.state in {'staging', 'draft'} and not m.quantity])
 
     @dualmethod
+    @instrumented
     @ModelView.button
     #@Workflow.transition('assigned')
     def assign_try(cls, productions):
@@ -261,61 +1048,391 @@ class Production(metaclass=PoolMeta):
                     raise UserError(gettext(
                         'production_subcontract.no_incoming_shipment',
                             production=p.number))
+        subcontracts = [p for p in productions if p.purchase_request]
+        if subcontracts:
+            servable = set(cls._get_servable_subcontracts(subcontracts))
+            productions = [p for p in productions
+                if not p.purchase_request or p in servable]
+            if not productions:
+                return
         return super(Production, cls).assign_try(productions)
 
     @classmethod
+    def _get_servable_subcontracts(cls, productions):
+        """Return the productions for which the supplier stock can serve all
+        the inputs to assign
+
+        The quantities of all the products at all the supplier locations are
+        computed at once and consumed in the order of the productions.
+        """
+        pool = Pool()
+        Date = pool.get('ir.date')
+        Location = pool.get('stock.location')
+        Product = pool.get('product.product')
+        Uom = pool.get('product.uom')
+
+        def required_moves(production):
+            return [m for m in production.assign_moves
+                if m.assignation_required
+                and m.state in {'staging', 'draft'}]
+
+        company2productions = defaultdict(list)
+        for production in productions:
+            company2productions[production.company].append(production)
+
+        servable = []
+        for company, sub_productions in company2productions.items():
+            moves = [m for p in sub_productions for m in required_moves(p)]
+            if not moves:
+                servable.extend(sub_productions)
+                continue
+            locations = Location.search([
+                    ('parent', 'child_of',
+                        list({m.from_location.id for m in moves})),
+                    ])
+            with Transaction().set_context(company=company.id):
+                today = Date.today()
+            with Transaction().set_context(
+                    stock_date_end=today,
+                    stock_assign=True,
+                    company=company.id):
+                pbl = Product.products_by_location(
+                    [l.id for l in locations], with_childs=True,
+                    grouping_filter=(list({m.product.id for m in moves}),))
+
+            for production in sub_productions:
+                needs = defaultdict(float)
+                for move in required_moves(production):
+                    needs[move.from_location.id, move.product.id] += (
+                        Uom.compute_qty(move.unit, move.quantity,
+                            move.product.default_uom, round=False))
+                if all(pbl.get(k, 0) >= q for k, q in needs.items()):
+                    for key, quantity in needs.items():
+                        pbl[key] -= quantity
+                    servable.append(production)
+        return servable
+
+    @classmethod
+    @instrumented
     @ModelView.button
     @Workflow.transition('done')
     def do(cls, productions):
         InternalShipment = Pool().get('stock.shipment.internal')
         super(Production, cls).do(productions)
-        shipments = [x.incoming_shipment for x in productions if
-            x.incoming_shipment]
+        # incoming shipments may be shared by several productions
+        shipments = list({x.incoming_shipment for x in productions if
+            x.incoming_shipment})
         if shipments:
             InternalShipment.assign_try(shipments)
 
-    def get_cost(self, name):
+    @classmethod
+    @instrumented
+    def get_costs(cls, productions, name):
+        costs = {p.id: p.get_cost(name) for p in productions}
+
+        # The productions processed before the cost was stored are computed
+        subcontract_costs = cls._get_subcontract_costs(
+            [p for p in productions if p.subcontract_cost is None])
+        for production in productions:
+            if production.subcontract_cost is not None:
+                subcontract_cost = production.subcontract_cost
+            else:
+                subcontract_cost = subcontract_costs.get(production.id)
+            if subcontract_cost is not None:
+                costs[production.id] = round_price(
+                    costs[production.id] + subcontract_cost)
+        return costs
+
+    @classmethod
+    def _get_subcontract_costs(cls, productions):
+        """Return the unrounded cost of the subcontract purchase line of each
+        production which has one"""
         pool = Pool()
         Uom = pool.get('product.uom')
+        PurchaseRequest = pool.get('purchase.request')
+        PurchaseLine = pool.get('purchase.line')
+        Product = pool.get('product.product')
+        Template = pool.get('product.template')
+        production = cls.__table__()
+        request = PurchaseRequest.__table__()
+        line = PurchaseLine.__table__()
+        product = Product.__table__()
+        template = Template.__table__()
+        cursor = Transaction().connection.cursor()
 
-        cost = super().get_cost(name)
-        line = self.purchase_request and self.purchase_request.purchase_line
-        if not line:
-            return cost
+        lines = {}
+        for sub_ids in grouped_slice(
+                [p.id for p in productions], backend.MAX_QUERY_PARAMS):
+            cursor.execute(*production
+                .join(request,
+                    condition=production.purchase_request == request.id)
+                .join(line, condition=request.purchase_line == line.id)
+                .join(product, condition=production.product == product.id)
+                .join(template, condition=product.template == template.id)
+                .select(production.id, production.unit, production.quantity,
+                    template.default_uom, line.unit_price,
+                    where=fields.SQL_OPERATORS['in'](production.id, sub_ids)))
+            for production_id, *values in cursor:
+                lines[production_id] = values
 
-        quantity = Uom.compute_qty(
-            self.unit, self.quantity, self.product.default_uom)
+        uom_ids = set()
+        for unit, _, default_uom, _ in lines.values():
+            uom_ids.update([unit, default_uom])
+        uoms = {u.id: u for u in Uom.browse(list(uom_ids))}
+        costs = {}
+        for production_id, (unit, quantity, default_uom, unit_price) in (
+                lines.items()):
+            quantity = Uom.compute_qty(
+                uoms.get(unit), quantity, uoms.get(default_uom))
+            if unit_price is None:
+                unit_price = Decimal('0')
+            elif not isinstance(unit_price, Decimal):
+                unit_price = Decimal(str(unit_price))
+            costs[production_id] = Decimal(quantity) * unit_price
+        return costs
 
-        return round_price(cost + Decimal(quantity)
-            * (line.unit_price or Decimal('0')))
+    @classmethod
+    def set_subcontract_cost(cls, productions):
+        "Store the subcontract cost of productions with one write per value"
+        costs = cls._get_subcontract_costs(productions)
+        to_write = defaultdict(list)
+        for production in productions:
+            cost = costs.get(production.id)
+            if production.subcontract_cost != cost:
+                to_write[cost].append(production)
+        args = []
+        for cost, sub_productions in to_write.items():
+            args.extend((sub_productions, {'subcontract_cost': cost}))
+        if args:
+            cls.write(*args)
 
-# TODO: Internal shipment should be updated each time outputs are changed
 
 class Purchase(metaclass=PoolMeta):
     __name__ = 'purchase.purchase'
 
     @classmethod
+    @instrumented
     def process(cls, purchases):
         pool = Pool()
-        PurchaseRequest = pool.get('purchase.request')
         Production = pool.get('production')
+        Config = pool.get('production.configuration')
 
         super(Purchase, cls).process(purchases)
 
-        lines = []
-        for purchase in purchases:
-            for line in purchase.lines:
-                lines.append(line.id)
+        # The join finds no production for purchases without subcontract
+        purchase_ids = [p.id for p in purchases]
+        production_ids = cls._get_subcontract_production_ids(purchase_ids)
+        if not production_ids:
+            return
 
-        requests = PurchaseRequest.search([
-                ('purchase_line', 'in', lines),
-                ])
-        requests = [x.id for x in requests]
-        productions = Production.search([
-                ('purchase_request', 'in', requests),
-                ])
+        if Config(1).queue_subcontract_processing:
+            # One task per purchase with productions left to process
+            for purchase_id in purchase_ids:
+                if production_ids[purchase_id]:
+                    Production.__queue__.process_purchase_request(
+                        Production.browse(production_ids[purchase_id]))
+        else:
+            Production.process_purchase_request(Production.browse(
+                    [i for p in purchase_ids for i in production_ids[p]]))
+
+    @classmethod
+    def _get_subcontract_production_ids(cls, purchase_ids):
+        """Return the ids of the productions subcontracted by each purchase
+        that are not yet processed"""
+        pool = Pool()
+        PurchaseLine = pool.get('purchase.line')
+        PurchaseRequest = pool.get('purchase.request')
+        Production = pool.get('production')
+        line = PurchaseLine.__table__()
+        request = PurchaseRequest.__table__()
+        production = Production.__table__()
+        cursor = Transaction().connection.cursor()
+
+        production_ids = defaultdict(list)
+        for sub_ids in grouped_slice(purchase_ids, backend.MAX_QUERY_PARAMS):
+            cursor.execute(*production
+                .join(request,
+                    condition=production.purchase_request == request.id)
+                .join(line, condition=request.purchase_line == line.id)
+                .select(line.purchase, production.id,
+                    where=fields.SQL_OPERATORS['in'](line.purchase, sub_ids)
+                    & (production.incoming_shipment == Null)
+                    & (production.destination_warehouse == Null),
+                    order_by=production.id.asc))
+            for purchase_id, production_id in cursor:
+                production_ids[purchase_id].append(production_id)
+        return production_ids
+
+
+class PurchaseLine(metaclass=PoolMeta):
+    __name__ = 'purchase.line'
+
+    @classmethod
+    def write(cls, *args):
+        pool = Pool()
+        Production = pool.get('production')
+
+        # Only the lines whose cost values change invalidate the productions
+        actions = iter(args)
+        line_ids = set()
+        for lines, values in zip(actions, actions):
+            if values.keys() & {'unit_price', 'quantity', 'unit'}:
+                line_ids.update(l.id for l in lines)
+        line_ids = list(line_ids)
+        before = {l.id: l._subcontract_cost_key for l in cls.browse(line_ids)}
+
+        super().write(*args)
+
+        changed = [l.id for l in cls.browse(line_ids)
+            if l._subcontract_cost_key != before[l.id]]
+        productions = []
+        for sub_ids in grouped_slice(changed, backend.MAX_QUERY_PARAMS):
+            productions.extend(Production.search([
+                        ('purchase_request.purchase_line', 'in',
+                            list(sub_ids)),
+                        ('subcontract_cost', '!=', None),
+                        ]))
         if productions:
-            Production.process_purchase_request(productions)
+            Production.set_subcontract_cost(productions)
+
+    @property
+    def _subcontract_cost_key(self):
+        return (self.unit_price, self.quantity,
+            self.unit.id if self.unit else None)
+
+
+class SubcontractWork(ModelSQL, ModelView):
+    "Subcontract Work"
+    __name__ = 'production.subcontract.work'
+    company = fields.Many2One('company.company', 'Company', readonly=True)
+    supplier = fields.Many2One('party.party', 'Supplier', readonly=True,
+        context={
+            'company': Eval('company', -1),
+        }, depends=['company'])
+    supplier_warehouse = fields.Many2One('stock.location',
+        'Supplier Warehouse', readonly=True)
+    destination_warehouse = fields.Many2One('stock.location',
+        'Destination Warehouse', readonly=True)
+    state = fields.Selection('get_states', 'State', readonly=True)
+    productions = fields.Integer('Productions', readonly=True)
+    quantity = fields.Float('Quantity', digits='unit', readonly=True)
+    unit = fields.Many2One('product.uom', 'Unit', readonly=True)
+    spend = Monetary('Spend', currency='currency', digits='currency',
+        readonly=True)
+    currency = fields.Many2One('currency.currency', 'Currency',
+        readonly=True)
+
+    @classmethod
+    def __setup__(cls):
+        super().__setup__()
+        cls._order.insert(0, ('supplier', 'ASC'))
+
+    @classmethod
+    def get_states(cls):
+        Production = Pool().get('production')
+        return Production.fields_get(['state'])['state']['selection']
+
+    @classmethod
+    def table_query(cls):
+        pool = Pool()
+        Production = pool.get('production')
+        PurchaseRequest = pool.get('purchase.request')
+        PurchaseLine = pool.get('purchase.line')
+        Purchase = pool.get('purchase.purchase')
+        production = Production.__table__()
+        request = PurchaseRequest.__table__()
+        line = PurchaseLine.__table__()
+        purchase = Purchase.__table__()
+        context = Transaction().context
+
+        # The warehouse is the one of the supplier once processed
+        supplier_warehouse = Case(
+            (production.destination_warehouse != Null, production.warehouse),
+            else_=Null)
+        destination_warehouse = Coalesce(
+            production.destination_warehouse, production.warehouse)
+        spend = cls.spend.sql_cast(Sum(production.quantity * line.unit_price))
+        return (production
+            .join(request,
+                condition=production.purchase_request == request.id)
+            .join(line, 'LEFT', condition=request.purchase_line == line.id)
+            .join(purchase, 'LEFT', condition=line.purchase == purchase.id)
+            .select(
+                Min(production.id).as_('id'),
+                production.company.as_('company'),
+                production.supplier.as_('supplier'),
+                supplier_warehouse.as_('supplier_warehouse'),
+                destination_warehouse.as_('destination_warehouse'),
+                production.state.as_('state'),
+                Count(production.id).as_('productions'),
+                Sum(production.quantity).as_('quantity'),
+                production.unit.as_('unit'),
+                spend.as_('spend'),
+                purchase.currency.as_('currency'),
+                where=(production.company == context.get('company'))
+                & ~production.state.in_(['done', 'cancelled']),
+                group_by=[production.company, production.supplier,
+                    supplier_warehouse, destination_warehouse,
+                    production.state, production.unit, purchase.currency]))
+
+
+class SubcontractMetric(ModelSQL, ModelView):
+    "Subcontract Metric"
+    __name__ = 'production.subcontract.metric'
+    method = fields.Char('Method', required=True, readonly=True)
+    records = fields.Integer('Records', readonly=True)
+    duration = fields.Float('Duration', readonly=True, help='In seconds.')
+    queries = fields.Integer('Queries', readonly=True)
+
+    @classmethod
+    def __setup__(cls):
+        super().__setup__()
+        cls._order.insert(0, ('create_date', 'DESC'))
+
+
+class SubcontractMetricSummary(ModelSQL, ModelView):
+    "Subcontract Metric Summary"
+    __name__ = 'production.subcontract.metric.summary'
+    method = fields.Char('Method', readonly=True)
+    calls = fields.Integer('Calls', readonly=True)
+    records = fields.Integer('Records', readonly=True)
+    duration = fields.Float('Duration', digits=(12, 3), readonly=True,
+        help='In seconds.')
+    max_duration = fields.Float('Maximum Duration', digits=(12, 3),
+        readonly=True, help='In seconds.')
+    queries = fields.Integer('Queries', readonly=True)
+
+    @classmethod
+    def __setup__(cls):
+        super().__setup__()
+        cls._order.insert(0, ('method', 'ASC'))
+
+    @classmethod
+    def table_query(cls):
+        Metric = Pool().get('production.subcontract.metric')
+        metric = Metric.__table__()
+        return metric.select(
+            Min(metric.id).as_('id'),
+            metric.method.as_('method'),
+            Count(Literal('*')).as_('calls'),
+            Sum(metric.records).as_('records'),
+            Sum(metric.duration).as_('duration'),
+            Max(metric.duration).as_('max_duration'),
+            Sum(metric.queries).as_('queries'),
+            group_by=[metric.method])
+
+
+class Cron(metaclass=PoolMeta):
+    __name__ = 'ir.cron'
+
+    @classmethod
+    def __setup__(cls):
+        super().__setup__()
+        cls.method.selection.append(
+            ('production|create_subcontract_purchase_requests',
+                "Create Subcontract Purchase Requests"))
+        cls.methods_company_needed.add(
+            'production|create_subcontract_purchase_requests')
 
 
 class Move(metaclass=PoolMeta):
@@ -326,4 +1443,111 @@ class Move(metaclass=PoolMeta):
         models = super()._get_origin()
         if not 'purchase.request' in models:
             models.append('purchase.request')
-        return models
\ No newline at end of file
+        return models
+
+class ShipmentInternal(metaclass=PoolMeta):
+    __name__ = 'stock.shipment.internal'
+
+    @classmethod
+    def wait(cls, shipments, moves=None):
+        super().wait(shipments, moves=moves)
+        cls._assign_subcontract_productions(shipments)
+
+    @classmethod
+    def assign(cls, shipments):
+        super().assign(shipments)
+        cls._assign_subcontract_productions(shipments)
+
+    @classmethod
+    def _assign_subcontract_productions(cls, shipments):
+        "Try to assign the waiting productions subcontracted by shipments"
+        pool = Pool()
+        Production = pool.get('production')
+        Config = pool.get('production.configuration')
+
+        productions = []
+        for sub_shipments in grouped_slice(
+                shipments, backend.MAX_QUERY_PARAMS):
+            productions.extend(Production.search([
+                        ('incoming_shipment', 'in',
+                            [s.id for s in sub_shipments]),
+                        ('state', '=', 'waiting'),
+                        ], order=[('id', 'ASC')]))
+        if not productions:
+            return
+        if Config(1).queue_subcontract_assignment:
+            Production.__queue__.assign_try(productions)
+        else:
+            Production.assign_try(productions)
+
+
+class SubcontractPlan(Wizard):
+    "Plan Subcontract Processing"
+    __name__ = 'production.subcontract.plan'
+    start = StateView('production.subcontract.plan.start',
+        'production_subcontract.subcontract_plan_start_view_form', [
+            Button('Close', 'end', 'tryton-close', default=True),
+            ])
+
+    def default_start(self, fields):
+        pool = Pool()
+        Production = pool.get('production')
+        Purchase = pool.get('purchase.purchase')
+
+        if self.model.__name__ == 'purchase.purchase':
+            production_ids = Purchase._get_subcontract_production_ids(
+                [r.id for r in self.records])
+            productions = Production.browse(
+                [i for r in self.records for i in production_ids[r.id]])
+        else:
+            productions = self.records
+        plan = Production.plan_purchase_request(productions)
+
+        lines = []
+        for values in plan['productions']:
+            shipment = plan['shipments'][values['shipment']]
+            lines.append({
+                    'production': values['production'],
+                    'supplier_warehouse': values['warehouse'],
+                    'destination_warehouse': values['destination_warehouse'],
+                    'shipment': values['shipment'] + 1,
+                    'shipment_moves': len(shipment['moves']),
+                    })
+        for values in plan['errors']:
+            lines.append({
+                    'production': values['production'],
+                    'error': values['message'],
+                    })
+        return {
+            'lines': lines,
+            'shipments': len(plan['shipments']),
+            'moves': len(plan['moves']),
+            'errors': len(plan['errors']),
+            }
+
+
+class SubcontractPlanStart(ModelView):
+    "Plan Subcontract Processing"
+    __name__ = 'production.subcontract.plan.start'
+    lines = fields.One2Many(
+        'production.subcontract.plan.line', None, 'Lines', readonly=True)
+    shipments = fields.Integer('Shipments', readonly=True,
+        help='The number of incoming shipments to create.')
+    moves = fields.Integer('Moves', readonly=True,
+        help='The number of moves to relocate to the supplier warehouses.')
+    errors = fields.Integer('Errors', readonly=True,
+        help='The number of productions that can not be processed.')
+
+
+class SubcontractPlanLine(ModelView):
+    "Plan Subcontract Processing Line"
+    __name__ = 'production.subcontract.plan.line'
+    production = fields.Many2One('production', 'Production', readonly=True)
+    supplier_warehouse = fields.Many2One('stock.location',
+        'Supplier Warehouse', readonly=True)
+    destination_warehouse = fields.Many2One('stock.location',
+        'Destination Warehouse', readonly=True)
+    shipment = fields.Integer('Shipment', readonly=True,
+        help='The number of the incoming shipment of the production.')
+    shipment_moves = fields.Integer('Shipment Moves', readonly=True)
+    error = fields.Text('Error', readonly=True)
@@ -0,0 +1,348 @@
+# This file is part of Tryton.  The COPYRIGHT file at the top level of
+# this repository contains the full copyright notices and license terms.
+"""Benchmark of the subcontract workflow on synthetic data
+
+The database is configured like for the tests with the DB_NAME and
+TRYTOND_DATABASE_URI environment variables, for example::
+
+    DB_NAME=:memory: TRYTOND_DATABASE_URI=sqlite:// \\
+        python -m trytond.modules.production_subcontract.tests.benchmark \\
+        1000 10000
+
+With --lookup, the sizes are the number of rows of the production table
+used to measure the lookup of the productions of processed purchases.
+"""
+import argparse
+import csv
+import sys
+import time
+from contextlib import contextmanager
+from decimal import Decimal
+
+from sql import Column, Literal
+from sql.aggregate import Count
+
+from trytond import backend
+from trytond.pool import Pool
+from trytond.transaction import Transaction, TransactionError
+
+from ..production import count_queries
+
+
+def create_suppliers(count):
+    "Create count suppliers each with its own production warehouse"
+    pool = Pool()
+    Location = pool.get('stock.location')
+    Party = pool.get('party.party')
+
+    locations = Location.create([{
+                'name': '%s %s' % (type_.title(), i),
+                'type': (
+                    type_ if type_ in {'lost_found', 'production'}
+                    else 'storage'),
+                }
+            for i in range(count)
+            for type_ in [
+                'storage', 'input', 'output', 'lost_found', 'production']])
+    warehouses = Location.create([{
+                'name': 'Supplier Warehouse %s' % i,
+                'type': 'warehouse',
+                'storage_location': storage.id,
+                'input_location': input_.id,
+                'output_location': output.id,
+                'lost_found_location': lost_found.id,
+                'production_location': production.id,
+                }
+            for i, (storage, input_, output, lost_found, production) in
+            enumerate(zip(*[iter(locations)] * 5))])
+    return Party.create([{
+                'name': 'Supplier %s' % i,
+                'addresses': [('create', [{}])],
+                'production_warehouse': warehouse.id,
+                }
+            for i, warehouse in enumerate(warehouses)])
+
+
+def create_boms(count, components=2):
+    "Create count subcontracted BOMs with their products"
+    pool = Pool()
+    Uom = pool.get('product.uom')
+    Template = pool.get('product.template')
+    BOM = pool.get('production.bom')
+
+    unit, = Uom.search([('name', '=', 'Unit')])
+    service, = Template.create([{
+                'name': 'Subcontract',
+                'type': 'service',
+                'purchasable': True,
+                'default_uom': unit.id,
+                'purchase_uom': unit.id,
+                'list_price': Decimal(0),
+                'products': [('create', [{}])],
+                }])
+    service, = service.products
+    templates = Template.create([{
+                'name': 'Component %s' % i,
+                'type': 'goods',
+                'default_uom': unit.id,
+                'list_price': Decimal(5),
+                'products': [('create', [{'cost_price': Decimal(1)}])],
+                }
+            for i in range(components)] + [{
+                'name': 'Product %s' % i,
+                'type': 'goods',
+                'producible': True,
+                'default_uom': unit.id,
+                'list_price': Decimal(30),
+                'products': [('create', [{}])],
+                }
+            for i in range(count)])
+    inputs = [t.products[0] for t in templates[:components]]
+    products = [t.products[0] for t in templates[components:]]
+    return BOM.create([{
+                'name': product.rec_name,
+                'subcontract_product': service.id,
+                'inputs': [('create', [{
+                                'product': input_.id,
+                                'quantity': 2,
+                                'unit': unit.id,
+                                } for input_ in inputs])],
+                'outputs': [('create', [{
+                                'product': product.id,
+                                'quantity': 1,
+                                'unit': unit.id,
+                                }])],
+                }
+            for product in products])
+
+
+def create_productions(count, boms):
+    "Create count waiting subcontracted productions"
+    pool = Pool()
+    Location = pool.get('stock.location')
+    Production = pool.get('production')
+
+    warehouse, = Location.search([('code', '=', 'WH')])
+    productions = []
+    for i in range(count):
+        bom = boms[i % len(boms)]
+        product = bom.outputs[0].product
+        production = Production(
+            warehouse=warehouse,
+            location=warehouse.production_location,
+            product=product,
+            bom=bom,
+            unit=product.default_uom,
+            quantity=1,
+            subcontract_product=bom.subcontract_product)
+        production.explode_bom()
+        productions.append(production)
+    Production.save(productions)
+    Production.wait(productions)
+    return productions
+
+
+def create_stock(suppliers, boms, quantity):
+    "Fill the supplier warehouses with the BOM inputs"
+    pool = Pool()
+    Company = pool.get('company.company')
+    Location = pool.get('stock.location')
+    Move = pool.get('stock.move')
+
+    company = Company(Transaction().context['company'])
+    supplier_location, = Location.search([('code', '=', 'SUP')])
+    products = {i.product for b in boms for i in b.inputs}
+    moves = Move.create([{
+                'product': product.id,
+                'unit': product.default_uom.id,
+                'quantity': quantity,
+                'from_location': supplier_location.id,
+                'to_location': (
+                    supplier.production_warehouse.storage_location.id),
+                'unit_price': product.cost_price,
+                'currency': company.currency.id,
+                }
+            for supplier in suppliers
+            for product in products])
+    with Transaction().set_context(_skip_warnings=True):
+        Move.do(moves)
+
+
+def create_purchases(suppliers, productions):
+    "Create a processing purchase per supplier for the productions"
+    pool = Pool()
+    Date = pool.get('ir.date')
+    Purchase = pool.get('purchase.purchase')
+    Line = pool.get('purchase.line')
+    PurchaseRequest = pool.get('purchase.request')
+
+    purchases, requests = [], []
+    for i, supplier in enumerate(suppliers):
+        sub_productions = productions[i::len(suppliers)]
+        purchase = Purchase(
+            party=supplier,
+            invoice_address=supplier.addresses[0],
+            invoice_method='manual')
+        purchase.lines = [Line(
+                product=p.purchase_request.product,
+                unit=p.purchase_request.unit,
+                quantity=p.purchase_request.quantity,
+                unit_price=Decimal(10))
+            for p in sub_productions]
+        purchases.append(purchase)
+    Purchase.save(purchases)
+    for i, (supplier, purchase) in enumerate(zip(suppliers, purchases)):
+        sub_productions = productions[i::len(suppliers)]
+        for production, line in zip(sub_productions, purchase.lines):
+            request = production.purchase_request
+            request.purchase_line = line
+            request.party = supplier
+            requests.append(request)
+    PurchaseRequest.save(requests)
+    Purchase.write(purchases, {
+            'state': 'processing',
+            'purchase_date': Date.today(),
+            })
+    return purchases
+
+
+@contextmanager
+def measure(results, name, size, records):
+    "Append to results the duration and the queries of the block"
+    with count_queries() as queries:
+        start = time.perf_counter()
+        yield
+        duration = time.perf_counter() - start
+    results.append({
+            'entry point': name,
+            'size': size,
+            'records': len(records),
+            'seconds': round(duration, 3),
+            'queries': len(queries),
+            })
+
+
+def run(size, suppliers=3, boms=5):
+    "Run the workflow for size productions and return the measures"
+    pool = Pool()
+    Production = pool.get('production')
+    Purchase = pool.get('purchase.purchase')
+
+    results = []
+    suppliers = create_suppliers(suppliers)
+    boms = create_boms(boms)
+    create_stock(suppliers, boms, quantity=size * 2)
+    productions = create_productions(size, boms)
+
+    productions = Production.browse(productions)
+    with measure(results, 'create_purchase_request', size, productions):
+        Production.create_purchase_request(productions)
+
+    purchases = create_purchases(suppliers, Production.browse(productions))
+    purchases = Purchase.browse(purchases)
+    with measure(results, 'Purchase.process', size, purchases):
+        Purchase.process(purchases)
+
+    productions = Production.browse(productions)
+    with measure(results, 'assign_try', size, productions):
+        Production.assign_try(productions)
+
+    productions = Production.browse(
+        [p for p in Production.browse(productions) if p.state == 'assigned'])
+    Production.run(productions)
+    productions = Production.browse(productions)
+    with measure(results, 'do', size, productions):
+        Production.do(productions)
+
+    with measure(results, 'get_cost', size, productions):
+        Production.read([p.id for p in productions], ['cost'])
+    return results
+
+
+def fill_productions(size):
+    """Fill the production table up to size rows by copying its rows
+    without their subcontract links"""
+    pool = Pool()
+    Production = pool.get('production')
+    production = Production.__table__()
+    cursor = Transaction().connection.cursor()
+
+    skip = {'id', 'purchase_request', 'incoming_shipment',
+        'destination_warehouse', 'supplier'}
+    columns = [Column(production, n) for n, f in Production._fields.items()
+        if not hasattr(f, 'set') and n not in skip]
+    cursor.execute(*production.select(Count(Literal('*'))))
+    count, = cursor.fetchone()
+    while count < size:
+        copy = Production.__table__()
+        cursor.execute(*production.insert(columns, copy.select(
+                    *[Column(copy, c.name) for c in columns],
+                    limit=size - count)))
+        count += min(count, size - count)
+    if backend.name == 'postgresql':
+        cursor.execute('ANALYZE "%s"' % Production._table)
+
+
+def run_lookup(size, suppliers=3, boms=5, productions=100):
+    """Measure the lookup of the productions of processed purchases with
+    size rows in the production table"""
+    pool = Pool()
+    Production = pool.get('production')
+    Purchase = pool.get('purchase.purchase')
+
+    results = []
+    suppliers = create_suppliers(suppliers)
+    boms = create_boms(boms)
+    productions = create_productions(productions, boms)
+    Production.create_purchase_request(Production.browse(productions))
+    purchases = create_purchases(suppliers, Production.browse(productions))
+    fill_productions(size)
+
+    with measure(results, 'Purchase lookup', size, purchases):
+        Purchase._get_subcontract_production_ids([p.id for p in purchases])
+    return results
+
+
+def main(sizes, suppliers=3, boms=5, lookup=False, output=sys.stdout):
+    from trytond.modules.company.tests import create_company, set_company
+    from trytond.tests.test_tryton import DB_NAME, activate_module
+
+    activate_module('production_subcontract')
+    results = []
+    for size in sizes:
+        extras = {}
+        while True:
+            with Transaction().start(DB_NAME, 1, **extras) as transaction:
+                try:
+                    company = create_company()
+                    with set_company(company):
+                        func = run_lookup if lookup else run
+                        results.extend(
+                            func(size, suppliers=suppliers, boms=boms))
+                except TransactionError as e:
+                    e.fix(extras)
+                    continue
+                finally:
+                    transaction.rollback()
+            break
+    writer = csv.DictWriter(output, [
+            'entry point', 'size', 'records', 'seconds', 'queries'])
+    writer.writeheader()
+    writer.writerows(results)
+    return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('sizes', nargs='+', type=int, metavar='SIZE',
+        help="number of productions")
+    parser.add_argument('--suppliers', type=int, default=3,
+        help="number of suppliers (default: %(default)s)")
+    parser.add_argument('--boms', type=int, default=5,
+        help="number of BOMs (default: %(default)s)")
+    parser.add_argument('--lookup', action='store_true',
+        help="measure only the lookup of Purchase.process with SIZE rows "
+        "in the production table")
+    args = parser.parse_args()
+    main(args.sizes, suppliers=args.suppliers, boms=args.boms,
+        lookup=args.lookup)
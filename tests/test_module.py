@@ -1,14 +1,1146 @@
-
 # This file is part of Tryton.  The COPYRIGHT file at the top level of
 # this repository contains the full copyright notices and license terms.
+import unittest
+from decimal import Decimal
+from unittest.mock import patch
+
+from trytond import backend
+from trytond.config import config
+from trytond.exceptions import UserError
+from trytond.model.modelview import AccessButtonError
+from trytond.modules.company.tests import (
+    CompanyTestMixin, create_company, set_company)
+from trytond.pool import Pool
+from trytond.tests.test_tryton import ModuleTestCase, with_transaction
+from trytond.transaction import Transaction
+
+from . import benchmark
+from ..production import count_queries
+
+
+def create_subcontract_data(company):
+    pool = Pool()
+    Location = pool.get('stock.location')
+    Party = pool.get('party.party')
+    Address = pool.get('party.address')
+    Uom = pool.get('product.uom')
+    Template = pool.get('product.template')
+    Product = pool.get('product.product')
+    BOM = pool.get('production.bom')
+
+    unit, = Uom.search([('name', '=', 'Unit')])
+    storage, input_, output, lost_found, production = Location.create([{
+                'name': 'Supplier Storage', 'type': 'storage',
+                }, {
+                'name': 'Supplier Input', 'type': 'storage',
+                }, {
+                'name': 'Supplier Output', 'type': 'storage',
+                }, {
+                'name': 'Supplier Lost Found', 'type': 'lost_found',
+                }, {
+                'name': 'Supplier Production', 'type': 'production',
+                }])
+    supplier_warehouse = Location(
+        name='Supplier Warehouse', type='warehouse',
+        storage_location=storage, input_location=input_,
+        output_location=output, lost_found_location=lost_found,
+        production_location=production)
+    supplier_warehouse.save()
+
+    supplier = Party(name='Supplier', addresses=[Address()])
+    supplier.production_warehouse = supplier_warehouse
+    supplier.save()
+
+    template = Template(
+        name='Product', type='goods', producible=True,
+        default_uom=unit, list_price=Decimal(30))
+    template.save()
+    product = Product(template=template)
+    product.save()
+    component_template = Template(
+        name='Component', type='goods', default_uom=unit,
+        list_price=Decimal(5))
+    component_template.save()
+    component = Product(template=component_template)
+    component.save()
+    service_template = Template(
+        name='Subcontract', type='service', purchasable=True,
+        default_uom=unit, purchase_uom=unit, list_price=Decimal(0))
+    service_template.save()
+    service = Product(template=service_template)
+    service.save()
+
+    bom, = BOM.create([{
+                'name': 'Product',
+                'subcontract_product': service.id,
+                'inputs': [('create', [{
+                                'product': component.id,
+                                'quantity': 2,
+                                'unit': unit.id,
+                                }])],
+                'outputs': [('create', [{
+                                'product': product.id,
+                                'quantity': 1,
+                                'unit': unit.id,
+                                }])],
+                }])
+    return {
+        'supplier': supplier,
+        'supplier_warehouse': supplier_warehouse,
+        'product': product,
+        'component': component,
+        'service': service,
+        'bom': bom,
+        }
 
-from trytond.modules.company.tests import CompanyTestMixin
-from trytond.tests.test_tryton import ModuleTestCase
+
+def create_productions(data, count, quantity=1):
+    pool = Pool()
+    Production = pool.get('production')
+    Location = pool.get('stock.location')
+
+    warehouse, = Location.search([('code', '=', 'WH')])
+    productions = []
+    for _ in range(count):
+        production = Production(
+            warehouse=warehouse,
+            location=warehouse.production_location,
+            product=data['product'],
+            bom=data['bom'],
+            unit=data['product'].default_uom,
+            quantity=quantity,
+            subcontract_product=data['service'])
+        production.explode_bom()
+        productions.append(production)
+    Production.save(productions)
+    return productions
+
+
+def create_purchase(data, productions, unit_price=Decimal(10)):
+    "Create a processing purchase for the requests of productions"
+    pool = Pool()
+    Purchase = pool.get('purchase.purchase')
+    Line = pool.get('purchase.line')
+    PurchaseRequest = pool.get('purchase.request')
+    Date = pool.get('ir.date')
+
+    supplier = data['supplier']
+    purchase = Purchase(
+        party=supplier,
+        invoice_address=supplier.addresses[0],
+        invoice_method='manual')
+    purchase.lines = [Line(
+            product=p.purchase_request.product,
+            unit=p.purchase_request.unit,
+            quantity=p.purchase_request.quantity,
+            unit_price=unit_price)
+        for p in productions]
+    purchase.save()
+    requests = []
+    for production, line in zip(productions, purchase.lines):
+        request = production.purchase_request
+        request.purchase_line = line
+        request.party = supplier
+        requests.append(request)
+    PurchaseRequest.save(requests)
+    Purchase.write([purchase], {
+            'state': 'processing',
+            'purchase_date': Date.today(),
+            })
+    return purchase
 
 
 class ProductionSubcontractTestCase(CompanyTestMixin, ModuleTestCase):
     'Test ProductionSubcontract module'
     module = 'production_subcontract'
+    extras = ['stock_supply_production']
+
+    def run_tasks(self):
+        pool = Pool()
+        Queue = pool.get('ir.queue')
+        transaction = Transaction()
+        while transaction.tasks:
+            task = Queue(transaction.tasks.pop())
+            task.run()
+
+    @unittest.skipIf(
+        backend.name != 'sqlite', 'Query counting requires SQLite trace')
+    @with_transaction()
+    def test_create_purchase_request_query_count(self):
+        "Test create_purchase_request reads do not grow with the batch"
+        pool = Pool()
+        Production = pool.get('production')
+
+        company = create_company()
+        with set_company(company):
+            data = create_subcontract_data(company)
+            # Warm up the caches
+            Production.create_purchase_request(create_productions(data, 1))
+
+            counts = []
+            for size in [5, 25]:
+                productions = create_productions(data, size)
+                with count_queries() as queries:
+                    Production.create_purchase_request(productions)
+                self.assertTrue(all(p.purchase_request for p in productions))
+                reads = [q for q in queries if q.startswith('SELECT')]
+                # Only the INSERT of each request and the UPDATE of each
+                # production link remain per record
+                self.assertLessEqual(len(queries) - len(reads), 2 * size)
+                counts.append(len(reads))
+            self.assertEqual(counts[0], counts[1])
+
+    @with_transaction()
+    def test_process_purchase_request(self):
+        "Test process_purchase_request moves productions to the supplier"
+        pool = Pool()
+        Production = pool.get('production')
+        Location = pool.get('stock.location')
+
+        company = create_company()
+        with set_company(company):
+            data = create_subcontract_data(company)
+            warehouse, = Location.search([('code', '=', 'WH')])
+            supplier_warehouse = data['supplier_warehouse']
+            productions = create_productions(data, 3, quantity=2)
+            Production.wait(productions)
+            Production.create_purchase_request(productions)
+            create_purchase(data, productions)
+
+            Production.process_purchase_request(productions)
+
+            for production in productions:
+                self.assertEqual(production.warehouse, supplier_warehouse)
+                self.assertEqual(production.destination_warehouse, warehouse)
+                self.assertEqual(
+                    production.location,
+                    supplier_warehouse.production_location)
+                shipment = production.incoming_shipment
+                self.assertEqual(shipment.state, 'waiting')
+                self.assertEqual(
+                    shipment.from_location,
+                    supplier_warehouse.storage_location)
+                self.assertEqual(
+                    shipment.to_location, warehouse.storage_location)
+                move, = shipment.outgoing_moves
+                self.assertEqual(move.product, data['product'])
+                self.assertEqual(move.quantity, 2)
+                input_, = production.inputs
+                self.assertEqual(
+                    input_.from_location,
+                    supplier_warehouse.storage_location)
+                self.assertEqual(
+                    input_.to_location,
+                    supplier_warehouse.production_location)
+                output, = production.outputs
+                self.assertEqual(
+                    output.from_location,
+                    supplier_warehouse.production_location)
+                self.assertEqual(
+                    output.to_location, supplier_warehouse.storage_location)
+            self.assertEqual(
+                len({p.incoming_shipment for p in productions}), 3)
+
+            # Already processed productions are skipped
+            Production.process_purchase_request(productions)
+            self.assertEqual(
+                len({p.incoming_shipment for p in productions}), 3)
+
+    @with_transaction()
+    def test_lock_unprocessed(self):
+        "Test only the productions still unprocessed in the database are kept"
+        pool = Pool()
+        Production = pool.get('production')
+
+        company = create_company()
+        with set_company(company):
+            data = create_subcontract_data(company)
+            productions = create_productions(data, 3)
+            Production.create_purchase_request(productions)
+            create_purchase(data, productions)
+            self.assertEqual(
+                Production._lock_unprocessed(productions), productions)
+
+            Production.process_purchase_request(productions[:2])
+
+            self.assertEqual(
+                Production._lock_unprocessed(productions), productions[2:])
+
+    @with_transaction()
+    def test_plan_purchase_request(self):
+        "Test planning the processing writes nothing"
+        pool = Pool()
+        Production = pool.get('production')
+        Purchase = pool.get('purchase.purchase')
+        ShipmentInternal = pool.get('stock.shipment.internal')
+        SubcontractPlan = pool.get(
+            'production.subcontract.plan', type='wizard')
+
+        company = create_company()
+        with set_company(company):
+            data = create_subcontract_data(company)
+            productions = create_productions(data, 2)
+            Production.wait(productions)
+            Production.create_purchase_request(productions)
+            purchase = create_purchase(data, productions)
+            Purchase.write([purchase], {'state': 'quotation'})
+            warehouse = productions[0].warehouse
+            supplier_warehouse = data['supplier_warehouse']
+
+            plan = Production.plan_purchase_request(productions)
+
+            self.assertEqual(plan['productions'], [{
+                        'production': p.id,
+                        'warehouse': supplier_warehouse.id,
+                        'destination_warehouse': warehouse.id,
+                        'shipment': i,
+                        } for i, p in enumerate(productions)])
+            shipment = plan['shipments'][0]
+            self.assertEqual(shipment['from_location'],
+                supplier_warehouse.storage_location.id)
+            self.assertEqual(shipment['to_location'],
+                warehouse.storage_location.id)
+            self.assertEqual(shipment['moves'], [{
+                        'product': data['product'].id,
+                        'quantity': 1,
+                        'unit': data['product'].default_uom.id,
+                        }])
+            self.assertEqual(len(plan['moves']), 4)
+            self.assertEqual(plan['errors'], [])
+            self.assertFalse(ShipmentInternal.search([]))
+            self.assertFalse(any(
+                    p.destination_warehouse
+                    for p in Production.browse(productions)))
+
+            with Transaction().set_context(
+                    active_model='purchase.purchase',
+                    active_id=purchase.id, active_ids=[purchase.id]):
+                session_id, _, _ = SubcontractPlan.create()
+                result = SubcontractPlan.execute(session_id, {}, 'start')
+            defaults = result['view']['defaults']
+            self.assertEqual(defaults['shipments'], 2)
+            self.assertEqual(defaults['moves'], 4)
+            self.assertEqual(defaults['errors'], 0)
+            self.assertEqual(
+                [l['production'] for l in defaults['lines']],
+                [p.id for p in productions])
+
+            Purchase.write([purchase], {'state': 'processing'})
+            Production.process_purchase_request(productions)
+            self.assertEqual(
+                Production.plan_purchase_request(productions)['productions'],
+                [])
+
+    @with_transaction()
+    def test_relocate_moves(self):
+        "Test relocation writes the moves with one UPDATE per pair"
+        pool = Pool()
+        Production = pool.get('production')
+        Move = pool.get('stock.move')
+
+        company = create_company()
+        with set_company(company):
+            data = create_subcontract_data(company)
+            supplier_warehouse = data['supplier_warehouse']
+            storage = supplier_warehouse.storage_location
+            production_location = supplier_warehouse.production_location
+            productions = create_productions(data, 5)
+            inputs = [m for p in productions for m in p.inputs]
+            outputs = [m for p in productions for m in p.outputs]
+            Move.cancel(inputs[:1])
+
+            with count_queries() as queries:
+                Production._relocate_moves({
+                        (storage, production_location): inputs,
+                        (production_location, storage): outputs,
+                        })
+            updates = [q for q in queries
+                if q.startswith('UPDATE "stock_move"')]
+            self.assertEqual(len(updates), 2)
+
+            inputs = Move.browse(inputs)
+            self.assertNotEqual(inputs[0].from_location, storage)
+            self.assertEqual(
+                {(m.from_location, m.to_location) for m in inputs[1:]},
+                {(storage, production_location)})
+            self.assertEqual(
+                {(m.from_location, m.to_location)
+                    for m in Move.browse(outputs)},
+                {(production_location, storage)})
+
+    @with_transaction()
+    def test_process_purchase_request_assigned(self):
+        "Test productions with assigned moves are rejected"
+        pool = Pool()
+        Production = pool.get('production')
+        Move = pool.get('stock.move')
+
+        company = create_company()
+        with set_company(company):
+            data = create_subcontract_data(company)
+            productions = create_productions(data, 2)
+            Production.wait(productions)
+            Production.create_purchase_request(productions)
+            create_purchase(data, productions)
+            warehouse = productions[0].warehouse
+            Move.assign(productions[0].inputs)
+
+            with self.assertRaises(UserError) as cm:
+                Production.process_purchase_request(productions)
+            self.assertIn(productions[0].rec_name, str(cm.exception))
+
+            rejected = Production.process_purchase_request(
+                productions, skip_invalid=True)
+            self.assertEqual(rejected, [productions[0].id])
+            production, processed = Production.browse(productions)
+            self.assertEqual(production.warehouse, warehouse)
+            self.assertFalse(production.incoming_shipment)
+            self.assertEqual(
+                processed.warehouse, data['supplier_warehouse'])
+
+    @with_transaction()
+    def test_process_purchase_request_invalid(self):
+        "Test process_purchase_request reports all invalid productions"
+        pool = Pool()
+        Production = pool.get('production')
+        Party = pool.get('party.party')
+        Location = pool.get('stock.location')
+
+        company = create_company()
+        with set_company(company):
+            data = create_subcontract_data(company)
+            warehouse, = Location.search([('code', '=', 'WH')])
+            other, same = Party.create([{
+                        'name': 'Other',
+                        'addresses': [('create', [{}])],
+                        }, {
+                        'name': 'Same',
+                        'addresses': [('create', [{}])],
+                        'production_warehouse': warehouse.id,
+                        }])
+            productions = create_productions(data, 3)
+            Production.create_purchase_request(productions)
+            create_purchase(data, productions[:1])
+            create_purchase(dict(data, supplier=other), productions[1:2])
+            create_purchase(dict(data, supplier=same), productions[2:])
+
+            with self.assertRaises(UserError) as cm:
+                Production.process_purchase_request(productions)
+            self.assertIn('Other', cm.exception.description)
+            self.assertIn(
+                productions[2].rec_name, cm.exception.description)
+            self.assertFalse(any(p.incoming_shipment for p in productions))
+
+            rejected = Production.process_purchase_request(
+                productions, skip_invalid=True)
+            self.assertEqual(rejected, [p.id for p in productions[1:]])
+            productions = Production.browse(productions)
+            self.assertTrue(productions[0].incoming_shipment)
+            self.assertFalse(any(
+                    p.incoming_shipment for p in productions[1:]))
+
+    @with_transaction()
+    def test_get_production_warehouses(self):
+        "Test production warehouses are resolved in batch and cached"
+        pool = Pool()
+        Party = pool.get('party.party')
+        Location = pool.get('stock.location')
+
+        company = create_company()
+        with set_company(company):
+            data = create_subcontract_data(company)
+            supplier = data['supplier']
+            supplier_warehouse = data['supplier_warehouse']
+            other, = Party.create([{'name': 'Other'}])
+
+            self.assertEqual(
+                Party.get_production_warehouses([supplier, other]), {
+                    supplier.id: supplier_warehouse.id,
+                    other.id: None,
+                    })
+            with count_queries() as queries:
+                Party.get_production_warehouses([supplier, other])
+            self.assertEqual(queries, [])
+
+            warehouse, = Location.search([('code', '=', 'WH')])
+            Party.write([other], {'production_warehouse': warehouse.id})
+            self.assertEqual(
+                Party.get_production_warehouses([other]),
+                {other.id: warehouse.id})
+
+    @with_transaction()
+    def test_process_purchase_request_grouped(self):
+        "Test process_purchase_request with grouped incoming shipments"
+        pool = Pool()
+        Production = pool.get('production')
+        Configuration = pool.get('production.configuration')
+
+        company = create_company()
+        with set_company(company):
+            configuration = Configuration(1)
+            configuration.group_incoming_shipments = True
+            configuration.save()
+            data = create_subcontract_data(company)
+            productions = create_productions(data, 3, quantity=2)
+            Production.wait(productions)
+            Production.create_purchase_request(productions)
+            create_purchase(data, productions)
+
+            Production.process_purchase_request(productions)
+
+            shipment, = {p.incoming_shipment for p in productions}
+            self.assertEqual(shipment.state, 'waiting')
+            self.assertEqual(len(shipment.outgoing_moves), 3)
+            self.assertEqual(
+                sum(m.quantity for m in shipment.outgoing_moves), 6)
+
+    @with_transaction()
+    def test_sync_outputs_to_shipment(self):
+        "Test outputs changes are applied to the incoming shipment"
+        pool = Pool()
+        Production = pool.get('production')
+
+        company = create_company()
+        with set_company(company):
+            data = create_subcontract_data(company)
+            productions = create_productions(data, 1, quantity=2)
+            Production.wait(productions)
+            Production.create_purchase_request(productions)
+            create_purchase(data, productions)
+            Production.process_purchase_request(productions)
+            production, = productions
+            shipment = production.incoming_shipment
+            outgoing_move, = shipment.outgoing_moves
+            output, = production.outputs
+
+            Production.write([production], {
+                    'outputs': [('write', [output.id], {'quantity': 5})],
+                    })
+            shipment = Production(production.id).incoming_shipment
+            move, = shipment.outgoing_moves
+            self.assertEqual(move, outgoing_move)
+            self.assertEqual(move.quantity, 5)
+            self.assertEqual(
+                [m.quantity for m in shipment.incoming_moves], [5])
+
+            Production.write([production], {
+                    'outputs': [('create', [{
+                                    'product': data['component'].id,
+                                    'unit': output.unit.id,
+                                    'quantity': 3,
+                                    'from_location': output.from_location.id,
+                                    'to_location': output.to_location.id,
+                                    'company': company.id,
+                                    'unit_price': 0,
+                                    'currency': company.currency.id,
+                                    }])],
+                    })
+            shipment = Production(production.id).incoming_shipment
+            self.assertEqual(
+                sorted((m.product.name, m.quantity)
+                    for m in shipment.outgoing_moves),
+                [('Component', 3), ('Product', 5)])
+            self.assertEqual(
+                sorted((m.product.name, m.quantity)
+                    for m in shipment.incoming_moves),
+                [('Component', 3), ('Product', 5)])
+
+            Production.write([production], {
+                    'outputs': [('delete', [output.id])],
+                    })
+            shipment = Production(production.id).incoming_shipment
+            self.assertEqual(
+                [(m.product.name, m.quantity)
+                    for m in shipment.outgoing_moves],
+                [('Component', 3)])
+            self.assertEqual(
+                [(m.product.name, m.quantity)
+                    for m in shipment.incoming_moves],
+                [('Component', 3)])
+
+    @with_transaction()
+    def test_assign_try_servable(self):
+        "Test only the productions served by the supplier stock are assigned"
+        pool = Pool()
+        Production = pool.get('production')
+        Location = pool.get('stock.location')
+        Move = pool.get('stock.move')
+
+        company = create_company()
+        with set_company(company):
+            data = create_subcontract_data(company)
+            productions = create_productions(data, 3)
+            Production.wait(productions)
+            Production.create_purchase_request(productions)
+            create_purchase(data, productions)
+            Production.process_purchase_request(productions)
+            supplier, = Location.search([('code', '=', 'SUP')])
+            component = data['component']
+            move = Move(
+                product=component,
+                unit=component.default_uom,
+                quantity=5,
+                from_location=supplier,
+                to_location=data['supplier_warehouse'].storage_location,
+                unit_price=Decimal(1),
+                currency=company.currency)
+            move.save()
+            with Transaction().set_context(_skip_warnings=True):
+                Move.do([move])
+
+            self.assertEqual(
+                Production._get_servable_subcontracts(productions),
+                productions[:2])
+
+            Production.assign_try(productions)
+
+            self.assertEqual(
+                [p.state for p in Production.browse(productions)],
+                ['assigned', 'assigned', 'waiting'])
+            self.assertEqual(
+                [(m.state, m.quantity) for m in productions[2].inputs],
+                [('draft', 2)])
+
+    @with_transaction()
+    def test_shipment_assign_productions(self):
+        "Test waiting the incoming shipment tries to assign its productions"
+        pool = Pool()
+        Production = pool.get('production')
+        Location = pool.get('stock.location')
+        Move = pool.get('stock.move')
+        ShipmentInternal = pool.get('stock.shipment.internal')
+        Configuration = pool.get('production.configuration')
+
+        company = create_company()
+        with set_company(company):
+            data = create_subcontract_data(company)
+            productions = create_productions(data, 2)
+            Production.wait(productions)
+            Production.create_purchase_request(productions)
+            create_purchase(data, productions)
+            Production.process_purchase_request(productions)
+            self.assertEqual(
+                [p.state for p in Production.browse(productions)],
+                ['waiting', 'waiting'])
+
+            shipments = [p.incoming_shipment for p in productions]
+            ShipmentInternal.draft(shipments)
+            with patch.object(
+                    Production, 'search', wraps=Production.search) as search:
+                ShipmentInternal.wait(shipments)
+            search.assert_called_once()
+
+            supplier, = Location.search([('code', '=', 'SUP')])
+            component = data['component']
+            move = Move(
+                product=component,
+                unit=component.default_uom,
+                quantity=4,
+                from_location=supplier,
+                to_location=data['supplier_warehouse'].storage_location,
+                unit_price=Decimal(1),
+                currency=company.currency)
+            move.save()
+            with Transaction().set_context(_skip_warnings=True):
+                Move.do([move])
+            shipment = productions[0].incoming_shipment
+            ShipmentInternal.draft([shipment])
+
+            configuration = Configuration(1)
+            configuration.queue_subcontract_assignment = True
+            configuration.save()
+            ShipmentInternal.wait([shipment])
+            self.assertEqual(len(Transaction().tasks), 1)
+            self.assertEqual(Production(productions[0].id).state, 'waiting')
+
+            self.run_tasks()
+            self.assertEqual(
+                [p.state for p in Production.browse(productions)],
+                ['assigned', 'waiting'])
+
+    @with_transaction()
+    def test_reverse_purchase_request(self):
+        "Test reversing processed productions with the button"
+        pool = Pool()
+        Production = pool.get('production')
+        User = pool.get('res.user')
+        Group = pool.get('res.group')
+        ModelData = pool.get('ir.model.data')
+        ShipmentInternal = pool.get('stock.shipment.internal')
+        Configuration = pool.get('production.configuration')
+
+        company = create_company()
+        with set_company(company):
+            configuration = Configuration(1)
+            configuration.group_incoming_shipments = True
+            configuration.save()
+            data = create_subcontract_data(company)
+            productions = create_productions(data, 3)
+            Production.wait(productions)
+            Production.create_purchase_request(productions)
+            create_purchase(data, productions)
+            Production.process_purchase_request(productions)
+            warehouse = productions[0].destination_warehouse
+            shipment = productions[0].incoming_shipment
+
+            self.assertIn('reverse_purchase_request', Production.__rpc__)
+            group = Group(ModelData.get_id('production', 'group_production'))
+            user, = User.create([{
+                        'login': 'production',
+                        'groups': [('add', [group.id])],
+                        'companies': [('add', [company.id])],
+                        'company': company.id,
+                        }])
+            other, = User.create([{
+                        'login': 'other',
+                        'companies': [('add', [company.id])],
+                        'company': company.id,
+                        }])
+            with Transaction().set_user(other.id), \
+                    Transaction().set_context(_check_access=True), \
+                    self.assertRaises(AccessButtonError):
+                Production.reverse_purchase_request(
+                    Production.browse(productions[:2]))
+            with Transaction().set_user(user.id), \
+                    Transaction().set_context(_check_access=True):
+                Production.reverse_purchase_request(
+                    Production.browse(productions[:2]))
+
+            reversed_, kept = (
+                Production.browse(productions[:2]),
+                Production(productions[2].id))
+            for production in reversed_:
+                self.assertEqual(production.warehouse, warehouse)
+                self.assertEqual(
+                    production.location, warehouse.production_location)
+                self.assertIsNone(production.destination_warehouse)
+                self.assertIsNone(production.incoming_shipment)
+                input_, = production.inputs
+                self.assertEqual(
+                    input_.from_location, warehouse.storage_location)
+                output, = production.outputs
+                self.assertEqual(
+                    output.to_location, warehouse.storage_location)
+            self.assertEqual(kept.incoming_shipment, shipment)
+            move, = ShipmentInternal(shipment.id).outgoing_moves
+            self.assertEqual(move.quantity, 1)
+
+            Production.reverse_purchase_request([kept])
+            self.assertFalse(ShipmentInternal.search(
+                    [('id', '=', shipment.id)]))
+
+    @with_transaction()
+    def test_get_costs(self):
+        "Test cost includes the subcontract purchase line"
+        pool = Pool()
+        Production = pool.get('production')
+        Uom = pool.get('product.uom')
+
+        company = create_company()
+        with set_company(company):
+            data = create_subcontract_data(company)
+            unit = data['product'].default_uom
+            dozen = Uom(
+                name='Dozen', symbol='dz', category=unit.category,
+                factor=12, rate=round(1 / 12, 12), rounding=1, digits=0)
+            dozen.save()
+            productions = create_productions(data, 3, quantity=2)
+            Production.write(productions[-1:], {'unit': dozen.id})
+            Production.create_purchase_request(productions[1:])
+            create_purchase(
+                data, productions[1:], unit_price=Decimal('2.5'))
+
+            self.assertEqual(
+                [p.cost for p in Production.browse(productions)],
+                [Decimal(0), Decimal(5), Decimal(60)])
+
+    @with_transaction()
+    def test_get_costs_rounding(self):
+        "Test the cost is rounded once with the subcontract cost"
+        pool = Pool()
+        Production = pool.get('production')
+        Uom = pool.get('product.uom')
+
+        company = create_company()
+        with set_company(company):
+            data = create_subcontract_data(company)
+            unit = data['product'].default_uom
+            Uom.write([unit], {'rounding': 0.1, 'digits': 1})
+            productions = create_productions(data, 1, quantity=0.5)
+            Production.wait(productions)
+            Production.create_purchase_request(productions)
+            create_purchase(data, productions, unit_price=Decimal('0.0003'))
+
+            with patch.object(
+                    Production, 'get_cost', return_value=Decimal('0.0001')):
+                production, = Production.browse(productions)
+                self.assertEqual(production.cost, Decimal('0.0002'))
+
+                Production.process_purchase_request(productions)
+                production, = Production.browse(productions)
+                self.assertEqual(
+                    production.subcontract_cost, Decimal('0.00015'))
+                self.assertEqual(production.cost, Decimal('0.0002'))
+
+    @with_transaction()
+    def test_subcontract_cost(self):
+        "Test the subcontract cost is stored and updated on line changes"
+        pool = Pool()
+        Production = pool.get('production')
+        PurchaseLine = pool.get('purchase.line')
+
+        company = create_company()
+        with set_company(company):
+            data = create_subcontract_data(company)
+            productions = create_productions(data, 2, quantity=2)
+            Production.wait(productions)
+            Production.create_purchase_request(productions)
+            create_purchase(data, productions, unit_price=Decimal('2.5'))
+            self.assertEqual(
+                [p.subcontract_cost for p in productions], [None, None])
+
+            Production.process_purchase_request(productions)
+            self.assertEqual(
+                [p.subcontract_cost for p in Production.browse(productions)],
+                [Decimal(5), Decimal(5)])
+
+            line = productions[0].purchase_request.purchase_line
+            PurchaseLine.write([line], {'unit_price': Decimal(3)})
+            PurchaseLine.write([line], {'note': 'Test'})
+            Production.write(productions[1:], {'quantity': 3})
+            productions = Production.browse(productions)
+            self.assertEqual(
+                [p.subcontract_cost for p in productions],
+                [Decimal(6), Decimal('7.5')])
+
+            lines = [p.purchase_request.purchase_line for p in productions]
+            with patch.object(
+                    Production, 'search', wraps=Production.search) as search:
+                PurchaseLine.write(lines, {'unit_price': Decimal(4)})
+            search.assert_called_once()
+            productions = Production.browse(productions)
+            self.assertEqual(
+                [p.subcontract_cost for p in productions],
+                [Decimal(8), Decimal(12)])
+            self.assertEqual(
+                [p.cost for p in productions], [Decimal(8), Decimal(12)])
+
+    @with_transaction()
+    def test_generate_requests(self):
+        "Test supply requests get the subcontract product of their BOM"
+        pool = Pool()
+        Production = pool.get('production')
+        Location = pool.get('stock.location')
+        OrderPoint = pool.get('stock.order_point')
+        ProductBOM = pool.get('product.product-production.bom')
+
+        company = create_company()
+        with set_company(company):
+            data = create_subcontract_data(company)
+            warehouse, = Location.search([('code', '=', 'WH')])
+            ProductBOM.create([{
+                        'product': data['product'].id,
+                        'bom': data['bom'].id,
+                        }])
+            OrderPoint.create([{
+                        'type': 'production',
+                        'product': data['product'].id,
+                        'location': warehouse.id,
+                        'min_quantity': 5,
+                        'target_quantity': 10,
+                        }])
+
+            request, = Production.generate_requests()
+
+            self.assertEqual(request.bom, data['bom'])
+            self.assertEqual(request.subcontract_product, data['service'])
+
+    @with_transaction()
+    def test_subcontract_work(self):
+        "Test the report of open subcontract work"
+        pool = Pool()
+        Production = pool.get('production')
+        Purchase = pool.get('purchase.purchase')
+        Work = pool.get('production.subcontract.work')
+        Location = pool.get('stock.location')
+
+        company = create_company()
+        with set_company(company):
+            data = create_subcontract_data(company)
+            warehouse, = Location.search([('code', '=', 'WH')])
+            productions = create_productions(data, 3, quantity=2)
+            Production.create_purchase_request(productions)
+            purchase = create_purchase(data, productions[:2])
+            Purchase.process([purchase])
+
+            processed, pending = Work.search(
+                [], order=[('supplier', 'ASC NULLS LAST')])
+
+            self.assertEqual(processed.supplier, data['supplier'])
+            self.assertEqual(
+                processed.supplier_warehouse, data['supplier_warehouse'])
+            self.assertEqual(processed.destination_warehouse, warehouse)
+            self.assertEqual(processed.state, 'draft')
+            self.assertEqual(processed.productions, 2)
+            self.assertEqual(processed.quantity, 4)
+            self.assertEqual(processed.spend, Decimal(40))
+            self.assertEqual(processed.currency, company.currency)
+
+            self.assertIsNone(pending.supplier)
+            self.assertIsNone(pending.supplier_warehouse)
+            self.assertEqual(pending.destination_warehouse, warehouse)
+            self.assertEqual(pending.productions, 1)
+            self.assertIsNone(pending.spend)
+
+    @with_transaction()
+    def test_supplier(self):
+        "Test supplier follows the party of the purchase request"
+        pool = Pool()
+        Production = pool.get('production')
+        PurchaseRequest = pool.get('purchase.request')
+
+        company = create_company()
+        with set_company(company):
+            data = create_subcontract_data(company)
+            supplier = data['supplier']
+            productions = create_productions(data, 2)
+            Production.create_purchase_request(productions)
+            self.assertEqual(
+                Production.search([('supplier', '=', supplier.id)]), [])
+
+            create_purchase(data, productions)
+            self.assertEqual(
+                Production.search([('supplier', '=', supplier.id)]),
+                productions)
+
+            PurchaseRequest.write(
+                [productions[0].purchase_request], {'party': None})
+            self.assertEqual(
+                Production.search([('supplier', '=', supplier.id)]),
+                productions[1:])
+
+            production, = Production.copy(productions[1:])
+            self.assertIsNone(production.supplier)
+
+    @with_transaction()
+    def test_aggregate_purchase_requests(self):
+        "Test productions share the purchase request of their supplier"
+        pool = Pool()
+        Production = pool.get('production')
+        Config = pool.get('production.configuration')
+        ProductSupplier = pool.get('purchase.product_supplier')
+        Purchase = pool.get('purchase.purchase')
+        PurchaseRequest = pool.get('purchase.request')
+
+        company = create_company()
+        with set_company(company):
+            data = create_subcontract_data(company)
+            supplier = data['supplier']
+            ProductSupplier.create([{
+                        'template': data['service'].template.id,
+                        'party': supplier.id,
+                        }])
+            Config.write([Config(1)], {'aggregate_purchase_requests': True})
+            productions = create_productions(data, 3)
+
+            with patch.object(PurchaseRequest, 'find_best_supplier',
+                    wraps=PurchaseRequest.find_best_supplier) as find:
+                Production.create_purchase_request(productions[:2])
+            find.assert_called_once()
+            Production.create_purchase_request(productions[2:])
+            request = productions[0].purchase_request
+            self.assertEqual(
+                {p.purchase_request for p in productions}, {request})
+            self.assertEqual(request.party, supplier)
+            self.assertEqual(request.quantity, 3)
+            self.assertEqual(request.productions, tuple(productions))
+            self.assertEqual(
+                [p.supplier for p in productions], [supplier] * 3)
+
+            purchase = create_purchase(data, productions[:1])
+            Purchase.process([purchase])
+            self.assertTrue(all(
+                    p.incoming_shipment
+                    for p in Production.browse(productions)))
+
+            # A purchased request does not receive other productions
+            production, = create_productions(data, 1)
+            Production.create_purchase_request([production])
+            self.assertNotEqual(production.purchase_request, request)
+            self.assertEqual(production.purchase_request.quantity, 1)
+
+    @with_transaction()
+    def test_purchase_process(self):
+        "Test processing the purchase processes its productions"
+        pool = Pool()
+        Production = pool.get('production')
+        Purchase = pool.get('purchase.purchase')
+
+        company = create_company()
+        with set_company(company):
+            data = create_subcontract_data(company)
+            productions = create_productions(data, 2)
+            other_productions = create_productions(data, 1)
+            Production.wait(productions + other_productions)
+            Production.create_purchase_request(
+                productions + other_productions)
+            purchase = create_purchase(data, productions)
+            create_purchase(data, other_productions)
+
+            Purchase.process([purchase])
+
+            self.assertTrue(all(
+                    p.incoming_shipment
+                    for p in Production.browse(productions)))
+            self.assertFalse(any(
+                    p.incoming_shipment
+                    for p in Production.browse(other_productions)))
+
+            with patch.object(
+                    Production, 'process_purchase_request') as process:
+                Purchase.process([purchase])
+            process.assert_not_called()
+
+    @with_transaction()
+    def test_purchase_request_origin(self):
+        "Test production is a purchase request origin"
+        pool = Pool()
+        PurchaseRequest = pool.get('purchase.request')
+
+        self.assertIn(('production', 'Production'),
+            PurchaseRequest.get_origin())
+
+    @with_transaction()
+    def test_purchase_process_queue(self):
+        "Test processing the purchase queues its productions"
+        pool = Pool()
+        Production = pool.get('production')
+        Purchase = pool.get('purchase.purchase')
+        Configuration = pool.get('production.configuration')
+
+        company = create_company()
+        with set_company(company):
+            configuration = Configuration(1)
+            configuration.queue_subcontract_processing = True
+            configuration.save()
+            data = create_subcontract_data(company)
+            productions = create_productions(data, 2)
+            Production.wait(productions)
+            Production.create_purchase_request(productions)
+            purchase = create_purchase(data, productions)
+
+            Purchase.process([purchase])
+            self.assertEqual(len(Transaction().tasks), 1)
+            self.assertFalse(any(
+                    p.incoming_shipment
+                    for p in Production.browse(productions)))
+
+            self.run_tasks()
+            shipments = [
+                p.incoming_shipment for p in Production.browse(productions)]
+            self.assertTrue(all(shipments))
+
+            # A second run does not queue the processed productions
+            Purchase.process([purchase])
+            self.assertEqual(len(Transaction().tasks), 0)
+            self.run_tasks()
+            self.assertEqual(
+                [p.incoming_shipment for p in Production.browse(productions)],
+                shipments)
+
+    @with_transaction()
+    def test_create_subcontract_purchase_requests(self):
+        "Test cron creates the missing purchase requests"
+        pool = Pool()
+        Production = pool.get('production')
+
+        company = create_company()
+        with set_company(company):
+            data = create_subcontract_data(company)
+            productions = create_productions(data, 3)
+            Production.create_purchase_request(productions[:1])
+            request = productions[0].purchase_request
+
+            with patch.object(Transaction(), 'commit') as commit:
+                Production.create_subcontract_purchase_requests(size=1)
+                self.assertEqual(commit.call_count, 2)
+
+            productions = Production.browse(productions)
+            self.assertEqual(productions[0].purchase_request, request)
+            self.assertTrue(all(p.purchase_request for p in productions))
+
+    @with_transaction()
+    def test_instrumentation(self):
+        "Test the instrumentation of the entry points"
+        pool = Pool()
+        Production = pool.get('production')
+        Metric = pool.get('production.subcontract.metric')
+        Summary = pool.get('production.subcontract.metric.summary')
+
+        company = create_company()
+        with set_company(company):
+            data = create_subcontract_data(company)
+            productions = create_productions(data, 3)
+
+            with self.assertNoLogs('trytond.modules.production_subcontract'):
+                Production.create_purchase_request(productions[:1])
+            self.assertEqual(Metric.search([], count=True), 0)
+
+            config.add_section('production_subcontract')
+            try:
+                config.set(
+                    'production_subcontract', 'instrumentation', 'True')
+                config.set(
+                    'production_subcontract', 'instrumentation_store', 'True')
+                with count_queries() as queries, self.assertLogs(
+                        'trytond.modules.production_subcontract') as logs:
+                    Production.create_purchase_request(productions[1:])
+                    Production.read(
+                        [p.id for p in productions], ['cost'])
+            finally:
+                config.remove_section('production_subcontract')
+
+            self.assertEqual(len(logs.records), 2)
+            self.assertIn(
+                'production.create_purchase_request: 2 records',
+                logs.output[0])
+            metric, = Metric.search(
+                [('method', '=', 'production.create_purchase_request')])
+            self.assertEqual(metric.records, 2)
+            self.assertGreater(metric.queries, 0)
+            summary, = Summary.search(
+                [('method', '=', 'production.get_costs')])
+            self.assertEqual(summary.calls, 1)
+            self.assertEqual(summary.records, 3)
+            # The enclosing counter keeps counting around nested ones
+            self.assertGreater(len(queries), metric.queries + summary.queries)
+
+    @with_transaction()
+    def test_benchmark(self):
+        "Test the benchmark runs on a small data set"
+        company = create_company()
+        with set_company(company):
+            results = benchmark.run(4, suppliers=2, boms=2)
+
+        self.assertEqual([r['entry point'] for r in results], [
+                'create_purchase_request', 'Purchase.process', 'assign_try',
+                'do', 'get_cost'])
+        self.assertTrue(all(r['records'] for r in results))
+
+    @with_transaction()
+    def test_benchmark_lookup(self):
+        "Test the lookup benchmark fills the production table"
+        pool = Pool()
+        Production = pool.get('production')
+
+        company = create_company()
+        with set_company(company):
+            result, = benchmark.run_lookup(
+                50, suppliers=2, boms=2, productions=4)
+
+            self.assertEqual(Production.search([], count=True), 50)
+        self.assertEqual(result['records'], 2)
+        self.assertEqual(result['queries'], 1)
 
 
 del ModuleTestCase